@@ -0,0 +1,198 @@
+"""
+Command Line Tool -- Extract Depth, Normals or Intrinsic Images from Many .exr Renders
+
+Frames are processed in parallel, each by a single worker at a time, and those whose
+outputs are newer than their inputs are skipped
+"""
+
+from argparse import ArgumentParser
+from glob import glob
+from multiprocessing import Pool, cpu_count
+from os import makedirs
+from os.path import abspath, commonpath, dirname, getmtime, join, relpath
+from queue import Queue
+from time import time
+import logging
+from tqdm import tqdm
+
+import config
+logger, thisfile = config.create_logger(abspath(__file__))
+logger.name = thisfile
+
+
+def inputs_of(task, frame):
+    # Depth comes from a pair of .exr files sharing a prefix, which is then the frame
+    if task == 'depth':
+        return [frame + '_a.exr', frame + '_z.exr']
+    return [frame]
+
+
+def outputs_of(task, outpath):
+    if task == 'intrinsic':
+        return [join(outpath, x + '.npy') for x in ['albedo', 'shading', 'specularity', 'recon', 'composite']]
+    return [outpath if outpath.endswith('.npy') else outpath + '.npy']
+
+
+def up_to_date(task, frame, outpath):
+    try:
+        t_out = min(getmtime(x) for x in outputs_of(task, outpath))
+    except OSError:
+        return False
+    return t_out >= max(getmtime(x) for x in inputs_of(task, frame))
+
+
+def list_frames(task, patterns, manifest, outdir):
+    """
+    Frames and where their outputs go, from glob patterns or a manifest
+
+    Returns:
+        frames: Input .exr path (or prefix for depth) and output path of each frame
+            List of (string, string) pairs
+    """
+    if manifest is not None:
+        # One frame per line, optionally followed by its output path
+        frames = []
+        with open(manifest) as f:
+            for l in f:
+                x = l.split()
+                if x:
+                    frames.append((x[0], x[1] if len(x) > 1 else None))
+    else:
+        frames = [(x, None) for p in patterns for x in sorted(glob(p))]
+    if task == 'depth':
+        # Either file of a pair stands for the pair
+        frames = [(x[:-len('_z.exr')], y) for x, y in frames if x.endswith('_z.exr')] + \
+            [(x, y) for x, y in frames if not x.endswith('.exr')]
+    if any(y is None for _, y in frames):
+        assert outdir is not None, "Output directory needed for frames without an output path"
+        # Mirroring where the frames are relative to each other
+        root = commonpath([dirname(abspath(x)) for x, _ in frames])
+        frames = [(x, y if y is not None else join(outdir, relpath(abspath(x), root).replace('.exr', '')))
+                  for x, y in frames]
+    return frames
+
+
+def init_worker():
+    # A log line per frame would drown the progress bar
+    logging.getLogger().setLevel(logging.WARNING)
+
+
+def process(job):
+    from xiuminglib.file_formats import exr
+
+    task, frame, outpath, vis, force = job
+    if not force and up_to_date(task, frame, outpath):
+        return frame, 'skipped'
+    try:
+        makedirs(outpath if task == 'intrinsic' else dirname(abspath(outpath)), exist_ok=True)
+        if task == 'depth':
+            exr.extract_depth(frame, outpath, vis=vis)
+        elif task == 'normal':
+            exr.extract_normal(frame, outpath, vis=vis)
+        else:
+            exr.extract_intrinsic_images_from_lighting_passes(frame, outpath, vis=vis)
+    except Exception as e: # pylint: disable=broad-except
+        return frame, '%s: %s' % (type(e).__name__, e)
+    return frame, 'done'
+
+
+def compute(job):
+    from xiuminglib.file_formats import exr
+
+    i, frame, dtype = job
+    try:
+        images = exr.intrinsic_images_from_lighting_passes(frame)
+    except Exception as e: # pylint: disable=broad-except
+        return i, frame, '%s: %s' % (type(e).__name__, e)
+    # Cast here, so that less goes back through the pipe
+    return i, frame, {k: v.astype(dtype) for k, v in images.items()}
+
+
+if __name__ == '__main__':
+    # Parse variables
+    parser = ArgumentParser(description="Extract depth, normals or intrinsic images from many .exr files in parallel")
+    parser.add_argument('task', type=str, choices=['depth', 'normal', 'intrinsic'], help="what to extract")
+    parser.add_argument('inputs', metavar='i', type=str, nargs='*',
+                        help=("glob patterns (quoted) of input .exr files; for depth, of the '*_z.exr' files "
+                              "whose '*_a.exr' counterparts sit next to them"))
+    parser.add_argument('--manifest', metavar='m', type=str, default=None,
+                        help="file listing an input (and optionally an output path) per line, instead of globs")
+    parser.add_argument('--outdir', metavar='o', type=str, default=None,
+                        help="where outputs go, mirroring the inputs' directory structure")
+    parser.add_argument('--workers', metavar='n', type=int, default=cpu_count(),
+                        help="number of worker processes (default: number of cores)")
+    parser.add_argument('--maxtasks', metavar='t', type=int, default=100,
+                        help="frames per worker before it's replaced by a fresh one, to cap memory (default: 100)")
+    parser.add_argument('--vis', action='store_true', help="also save visualizations as .png")
+    parser.add_argument('--force', action='store_true', help="redo frames whose outputs are up to date")
+    parser.add_argument('--store', metavar='s', type=str, default=None,
+                        help=("for intrinsic, a single .h5 file to write all frames into, in the input order, "
+                              "instead of .npy files; frames already there are skipped"))
+    parser.add_argument('--dtype', metavar='d', type=str, default='float16', choices=['float16', 'float32'],
+                        help="data type in --store (default: float16)")
+    args = parser.parse_args()
+
+    assert args.store is None or args.task == 'intrinsic', "Only intrinsic images can go into a store"
+    if args.store is not None:
+        # Outputs don't matter
+        args.outdir = ''
+    frames = list_frames(args.task, args.inputs, args.manifest, args.outdir)
+    logger.info("%d frames to go through", len(frames))
+
+    t0 = time()
+    counts = {'done': 0, 'skipped': 0, 'failed': 0}
+    pool = Pool(args.workers, initializer=init_worker, maxtasksperchild=args.maxtasks)
+    if args.store is None:
+        jobs = [(args.task, x, y, args.vis, args.force) for x, y in frames]
+        with tqdm(total=len(jobs)) as pbar:
+            for frame, status in pool.imap_unordered(process, jobs, chunksize=4):
+                if status in counts:
+                    counts[status] += 1
+                else:
+                    counts['failed'] += 1
+                    logger.error("%s failed: %s", frame, status)
+                pbar.update()
+    else:
+        from xiuminglib.file_formats import exr
+        with exr.Exr(frames[0][0]) as data:
+            shape = data.shape
+        # Only this process writes, as HDF5 files can't take concurrent writers
+        with exr.open_intrinsic_store(args.store, len(frames), shape, dtype=args.dtype) as store:
+            done = store['done'][:]
+            if args.force:
+                done[:] = False
+            jobs = [(i, x, args.dtype) for i, (x, _) in enumerate(frames) if not done[i]]
+            counts['skipped'] = len(frames) - len(jobs)
+            # Unlike imap_unordered(), which would compute all frames as fast as the workers go,
+            # only so many frames are let in flight, so that finished ones waiting to be
+            # written don't pile up in memory
+            results = Queue()
+
+            def submit(job):
+                # Errors compute() doesn't catch, e.g., in pickling, still have to come back
+                pool.apply_async(compute, (job,), callback=results.put, error_callback=lambda e: results.put(
+                    (job[0], job[1], '%s: %s' % (type(e).__name__, e))))
+
+            n_flight = 2 * args.workers
+            for job in jobs[:n_flight]:
+                submit(job)
+            with tqdm(total=len(jobs)) as pbar:
+                for k in range(len(jobs)):
+                    i, frame, images = results.get()
+                    if k + n_flight < len(jobs):
+                        submit(jobs[k + n_flight])
+                    if isinstance(images, dict):
+                        exr.write_intrinsic_frame(store, i, images)
+                        counts['done'] += 1
+                    else:
+                        counts['failed'] += 1
+                        logger.error("%s failed: %s", frame, images)
+                    pbar.update()
+    pool.close()
+    pool.join()
+    t_total = time() - t0
+
+    logger.info("%d done, %d skipped as up to date, %d failed, in %.1f seconds",
+                counts['done'], counts['skipped'], counts['failed'], t_total)
+    if counts['done'] > 0:
+        logger.info("Throughput: %.2f frames/second", counts['done'] / t_total)
@@ -0,0 +1,173 @@
+"""
+Command Line Tool -- Benchmark Loading .obj Files
+
+Times Obj.load_file() against the line-by-line parser it replaced, on generated grid meshes
+of given sizes, checking that both give the same model
+"""
+
+from argparse import ArgumentParser
+from os import remove
+from os.path import abspath, join
+from tempfile import mkdtemp
+from time import time
+import numpy as np
+
+import config
+logger, thisfile = config.create_logger(abspath(__file__))
+logger.name = thisfile
+
+from xiuminglib.geometry_models.ObjMtl import Obj
+
+
+def write_grid(obj_file, n_faces):
+    """
+    Write a grid mesh of about n_faces faces, with texture coordinates and normals, whose
+        first row of cells are quads (1/1/1 ...), the other rows triangles, half of those
+        without texture coordinates (1//1 ...)
+    """
+    m = max(int(np.ceil(np.sqrt(n_faces / 2.))), 1)
+    x, y = np.meshgrid(np.arange(m + 1), np.arange(m + 1))
+    v = np.stack((x.ravel(), y.ravel(), np.sin(x.ravel() * y.ravel())), axis=1)
+    vt = v[:, :2] / m
+    # Indices of each cell's corners, starting from 1
+    ind = np.arange((m + 1) ** 2).reshape(m + 1, m + 1) + 1
+    corners = np.stack((ind[:-1, :-1], ind[:-1, 1:], ind[1:, 1:], ind[1:, :-1]), axis=-1).reshape(-1, 4)
+    quads = corners[:m]
+    tris = np.concatenate((corners[m:, [0, 1, 2]], corners[m:, [0, 2, 3]]))
+    half = len(tris) // 2
+    with open(obj_file, 'w') as fid:
+        fid.write('o grid\n')
+        fid.write(''.join('v %f %f %f\n' % tuple(x) for x in v.tolist()))
+        fid.write(''.join('vt %f %f\n' % tuple(x) for x in vt.tolist()))
+        fid.write('vn 0 0 1\n')
+        fid.write('s off\n')
+        fid.write(''.join('f %d/%d/1 %d/%d/1 %d/%d/1 %d/%d/1\n' % (a, a, b, b, c, c, d, d)
+                          for a, b, c, d in quads.tolist()))
+        fid.write(''.join('f %d/%d/1 %d/%d/1 %d/%d/1\n' % (a, a, b, b, c, c) for a, b, c in tris[:half].tolist()))
+        fid.write(''.join('f %d//1 %d//1 %d//1\n' % tuple(x) for x in tris[half:].tolist()))
+    return len(quads) + len(tris)
+
+
+def load_by_line(obj_file):
+    # As Obj.load_file() was
+    with open(obj_file, 'r') as fid:
+        lines = [l.strip('\n') for l in fid.readlines()]
+    lines = [l for l in lines if len(l) > 0] # remove empty lines
+
+    # Check if there's only one object
+    n_o = len([l for l in lines if l[0] == 'o'])
+    if n_o > 1:
+        raise ValueError(".obj file containing multiple objects is not supported -- consider using 'assimp' instead")
+
+    # Count for array initializations
+    n_v = len([l for l in lines if l[:2] == 'v '])
+    n_vt = len([l for l in lines if l[:3] == 'vt '])
+    n_vn = len([l for l in lines if l[:3] == 'vn '])
+    lines_f = [l for l in lines if l[:2] == 'f ']
+    n_f = len(lines_f)
+
+    # Initialize arrays
+    mtllib = None
+    o = None
+    v = np.zeros((n_v, 3))
+    vt = np.zeros((n_vt, 2))
+    vn = np.zeros((n_vn, 3))
+    usemtl = None
+    s = False
+    f = [None] * n_f
+    # If there's no 'ft' or 'fn' for a 'f', a '[]' is inserted as a placeholder
+    # This guarantees 'f[i]' always corresponds to 'ft[i]' and 'fn[i]'
+    ft = [None] * n_f
+    fn = [None] * n_f
+
+    # Load data line by line
+    n_ft, n_fn = 0, 0
+    i_v, i_vt, i_vn, i_f = 0, 0, 0, 0
+    for l in lines:
+        if l[0] == '#': # comment
+            pass
+        elif l[:7] == 'mtllib ': # mtl file
+            mtllib = l[7:]
+        elif l[:2] == 'o ': # object name
+            o = l[2:]
+        elif l[:2] == 'v ': # geometric vertex
+            v[i_v, :] = [float(x) for x in l[2:].split(' ')]
+            i_v += 1
+        elif l[:3] == 'vt ': # texture vertex
+            vt[i_vt, :] = [float(x) for x in l[3:].split(' ')]
+            i_vt += 1
+        elif l[:3] == 'vn ': # normal vector
+            vn[i_vn, :] = [float(x) for x in l[3:].split(' ')]
+            i_vn += 1
+        elif l[:7] == 'usemtl ': # material name
+            usemtl = l[7:]
+        elif l[:2] == 's ': # group smoothing
+            if l[2:] == 'on':
+                s = True
+        elif l[:2] == 'f ': # face
+            n_slashes = l[2:].split(' ')[0].count('/')
+            if n_slashes == 0: # just f (1 2 3)
+                f[i_f] = [int(x) for x in l[2:].split(' ')]
+                ft[i_f] = []
+                fn[i_f] = []
+            elif n_slashes == 1: # f and ft (1/1 2/2 3/3)
+                f[i_f] = [int(x.split('/')[0]) for x in l[2:].split(' ')]
+                ft[i_f] = [int(x.split('/')[1]) for x in l[2:].split(' ')]
+                fn[i_f] = []
+                n_ft += 1
+            elif n_slashes == 2:
+                if l[2:].split(' ')[0].count('//') == 1: # f and fn (1//1 2//1 3//1)
+                    f[i_f] = [int(x.split('//')[0]) for x in l[2:].split(' ')]
+                    ft[i_f] = []
+                    fn[i_f] = [int(x.split('//')[1]) for x in l[2:].split(' ')]
+                    n_fn += 1
+                else: # f, ft and fn (1/1/1 2/2/1 3/3/1)
+                    f[i_f] = [int(x.split('/')[0]) for x in l[2:].split(' ')]
+                    ft[i_f] = [int(x.split('/')[1]) for x in l[2:].split(' ')]
+                    fn[i_f] = [int(x.split('/')[2]) for x in l[2:].split(' ')]
+                    n_ft += 1
+                    n_fn += 1
+            i_f += 1
+        else:
+            raise ValueError("Unidentified line type: %s" % l)
+
+    return v, vt if vt.shape[0] > 0 else None, vn if vn.shape[0] > 0 else None, \
+        f, ft if any(ft) else None, fn if any(fn) else None
+
+
+if __name__ == '__main__':
+    # Parse variables
+    parser = ArgumentParser(description="Benchmark loading .obj files")
+    parser.add_argument('--faces', metavar='n', type=str, default='10000,100000,1000000',
+                        help="comma-separated numbers of faces of the meshes (default: 10000,100000,1000000)")
+    parser.add_argument('--reps', metavar='r', type=int, default=3,
+                        help="number of timed loads, out of which the fastest counts (default: 3)")
+    parser.add_argument('--skip_baseline', action='store_true',
+                        help="time only Obj.load_file(), e.g., for meshes too large for the baseline")
+    args = parser.parse_args()
+
+    tmp_dir = mkdtemp()
+    for n in [int(x) for x in args.faces.split(',')]:
+        obj_file = join(tmp_dir, 'grid.obj')
+        n = write_grid(obj_file, n)
+
+        t_new = []
+        for _ in range(args.reps):
+            t0 = time()
+            obj = Obj()
+            obj.load_file(obj_file)
+            t_new.append(time() - t0)
+
+        if args.skip_baseline:
+            logger.info("%9d faces: %8.3fs", n, min(t_new))
+        else:
+            t_old = []
+            for _ in range(args.reps):
+                t0 = time()
+                old = load_by_line(obj_file)
+                t_old.append(time() - t0)
+            new = (obj.v, obj.vt, obj.vn) + tuple(obj.face_lists(x) for x in ('f', 'ft', 'fn'))
+            same = all(np.array_equal(x, y) for x, y in zip(old[:3], new[:3])) and old[3:] == new[3:]
+            logger.info("%9d faces: %8.3fs, vs. %8.3fs line by line (%.1fx); same model: %s",
+                        n, min(t_new), min(t_old), min(t_old) / min(t_new), same)
+        remove(obj_file)
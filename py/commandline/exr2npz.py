@@ -1,8 +1,6 @@
 """
 Command Line Tool -- Convert a .exr Image to a .npz Dictionary
 
-(Requires Python 2 for now, so writes to disk for compatibility with Python 3)
-
 Xiuming Zhang, MIT CSAIL
 Feburary 2018
 """
@@ -11,9 +9,8 @@ from argparse import ArgumentParser
 from os import makedirs
 from os.path import exists, abspath, dirname
 import numpy as np
-import OpenEXR
-import Imath
 
+from xiuminglib.file_formats import exr
 import config
 logger, thisfile = config.create_logger(abspath(__file__))
 logger.name = thisfile
@@ -23,6 +20,8 @@ logger.name = thisfile
 parser = ArgumentParser(description="Load OpenEXR image as dictionary of numpy arrays")
 parser.add_argument('input', metavar='i', type=str, help="input .exr file")
 parser.add_argument('outpath', metavar='o', type=str, help="output .npz file")
+parser.add_argument('--channels', metavar='c', type=str, default=None,
+                    help="comma-separated channels to convert, e.g., 'R,G,B'; default: all (only these get decoded)")
 args = parser.parse_args()
 inpath = args.input
 outpath = abspath(args.outpath)
@@ -34,17 +33,12 @@ outdir = dirname(outpath)
 if not exists(outdir):
     makedirs(outdir)
 
-f = OpenEXR.InputFile(inpath)
-pix_type = Imath.PixelType(Imath.PixelType.FLOAT)
-data_win = f.header()['dataWindow']
-win_size = (data_win.max.y - data_win.min.y + 1,
-            data_win.max.x - data_win.min.x + 1)
-
-imgs = {}
-for c in f.header()['channels']:
-    arr = np.fromstring(f.channel(c, pix_type), dtype=np.float32)
-    imgs[c] = arr.reshape(win_size)
-
-np.savez(outpath, **imgs)
+if args.channels is None:
+    np.savez(outpath, **exr.load(inpath))
+else:
+    with exr.Exr(inpath) as data:
+        chs = args.channels.split(',')
+        data.fetch(chs)
+        np.savez(outpath, **{x: data[x] for x in chs})
 
 logger.info("Generated %s", outpath)
@@ -0,0 +1,88 @@
+"""
+Ways of Starting exec_client on Machines
+
+All backends start the same client on the same pool_dir, so logging and
+resuming work the same regardless of where the jobs run.
+"""
+
+import sys
+from os.path import join, dirname, realpath
+from subprocess import call
+import logging
+
+import ssh_fanout
+
+
+class SshBackend(object):
+    """
+    One client per configured machine, started over ssh and left running
+    """
+    python = 'python'
+    # Whether launch() returns once clients have started
+    detached = True
+
+    def __init__(self, ssh='ssh', max_concurrency=32, timeout=30):
+        self.ssh = ssh
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+
+    def hosts(self, machine_list):
+        return machine_list
+
+    def wrap(self, curr_dir, client_cmd, out_file):
+        # Detached from the session, so that ssh returns as soon as the client
+        # has started; its output goes to a file in pool_dir instead
+        return 'cd {}; nohup {} < /dev/null > {} 2>&1 &'.format(curr_dir, client_cmd, out_file)
+
+    def describe(self, host, cmd):
+        return '{} {} "{}"'.format(self.ssh, host, cmd)
+
+    def launch(self, host_cmds):
+        results = ssh_fanout.fan_out(host_cmds, ssh=self.ssh, max_concurrency=self.max_concurrency,
+                                     timeout=self.timeout)
+        ssh_fanout.summarize(results, "accepted jobs")
+
+
+class FakeRemoteBackend(SshBackend):
+    """
+    Same as SshBackend, but every "machine" is in fact this one, for testing
+    """
+    python = sys.executable
+
+    def __init__(self, max_concurrency=32, timeout=30):
+        fake_ssh = join(dirname(realpath(__file__)), 'fake_ssh.py')
+        super(FakeRemoteBackend, self).__init__(
+            ssh='%s %s' % (sys.executable, fake_ssh), max_concurrency=max_concurrency, timeout=timeout)
+
+
+class LocalBackend(object):
+    """
+    A single client on this machine, using all its cores, in the foreground
+    """
+    python = sys.executable
+    detached = False
+
+    def hosts(self, machine_list):
+        return ['localhost']
+
+    def wrap(self, curr_dir, client_cmd, out_file):
+        return 'cd {}; {}'.format(curr_dir, client_cmd)
+
+    def describe(self, host, cmd):
+        return cmd
+
+    def launch(self, host_cmds):
+        for _, cmd in host_cmds:
+            s = call(cmd, shell=True)
+            if s != 0:
+                logging.error("Client exited with status %d", s)
+
+
+def get(name, ssh='ssh', max_concurrency=32, timeout=30):
+    if name == 'ssh':
+        return SshBackend(ssh=ssh, max_concurrency=max_concurrency, timeout=timeout)
+    if name == 'fake':
+        return FakeRemoteBackend(max_concurrency=max_concurrency, timeout=timeout)
+    if name == 'local':
+        return LocalBackend()
+    raise ValueError("Unknown backend: %s" % name)
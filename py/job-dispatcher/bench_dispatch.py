@@ -0,0 +1,191 @@
+"""
+Benchmarking Scheduling Strategies on a Simulated Cluster
+
+Simulated machines are exec_client processes on this machine, started through
+fake_ssh.py just as dispatch.py would start them. Jobs only sleep, for
+durations drawn from a given distribution and divided by the speed of
+whichever machine ends up running them, so that strategies can be compared by
+makespan, idle time and overhead without a cluster.
+"""
+
+import sys
+from random import Random
+from os import makedirs
+from os.path import join
+from glob import glob
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time, sleep
+from argparse import ArgumentParser
+import json
+import logging
+import dispatch
+import job_queue
+import backends
+
+# Run by exec_client as the job, wherever the job lands
+sim_job = '''import json, os, sys, time
+speeds = json.load(open(sys.argv[1]))
+time.sleep(float(sys.argv[2]) / speeds[os.environ['EXEC_CLIENT_HOST']])
+'''
+
+strategies = {
+    # Name: (schedule, stealing, queue)
+    'roundrobin': ('roundrobin', False, False),
+    'lpt': ('lpt', False, False),
+    'roundrobin+steal': ('roundrobin', True, False),
+    'lpt+steal': ('lpt', True, False),
+    'queue': ('roundrobin', False, True),
+    'queue+lpt': ('lpt', False, True),
+}
+
+
+def draw_durations(dist, n, rng):
+    # E.g., 'const:1', 'uniform:0.1,2', 'exp:0.5' (mean), 'lognormal:-1,1' (mu, sigma)
+    # or 'pareto:2,0.2' (alpha, minimum)
+    name, _, params = dist.partition(':')
+    params = [float(x) for x in params.split(',')]
+    if name == 'const':
+        return [params[0]] * n
+    if name == 'uniform':
+        return [rng.uniform(*params) for _ in range(n)]
+    if name == 'exp':
+        return [rng.expovariate(1 / params[0]) for _ in range(n)]
+    if name == 'lognormal':
+        return [rng.lognormvariate(*params) for _ in range(n)]
+    if name == 'pareto':
+        return [params[1] * rng.paretovariate(params[0]) for _ in range(n)]
+    raise ValueError("Unknown distribution: %s" % dist)
+
+
+def wait_for_clients(pool_dir, n_machines, timeout):
+    t_end = time() + timeout
+    while time() < t_end:
+        records = []
+        for status_file in glob(join(pool_dir, '*.status')):
+            with open(status_file) as f:
+                records.append(json.load(f))
+        if len(records) == n_machines and all(x['finished'] for x in records):
+            return records
+        sleep(0.05)
+    raise RuntimeError("Clients in %s didn't finish within %d seconds" % (pool_dir, timeout))
+
+
+def run_strategy(name, work_dir, durations, speeds, args):
+    schedule, steal, use_queue = strategies[name]
+    machine_list = sorted(speeds)
+    pool_dir = join(work_dir, name)
+    makedirs(pool_dir)
+    cmds = ['{} {} {} {:.4f} {}'.format(sys.executable, join(work_dir, 'sim_job.py'), join(work_dir, 'speeds.json'),
+                                        x, i) for i, x in enumerate(durations)]
+    cmd_expects = [['a-nonexistent-placeholder-file']] * len(cmds)
+    # As if from perfect runtime history, give or take some noise
+    rng = Random(args.seed)
+    est_runtimes = [x * rng.lognormvariate(0, args.estimate_noise) for x in durations]
+
+    t0 = time()
+    if use_queue:
+        if schedule == 'lpt':
+            order = sorted(range(len(cmds)), key=lambda i: -est_runtimes[i])
+            cmds = [cmds[i] for i in order]
+        job_queue.create(join(pool_dir, 'sim.queue'), cmds, cmd_expects)
+    elif schedule == 'lpt':
+        dispatch.split_jobs_lpt(cmds, cmd_expects, est_runtimes, machine_list, pool_dir, 'sim')
+    else:
+        dispatch.split_jobs(zip(cmds, cmd_expects), machine_list, pool_dir, 'sim', len(cmds))
+    t_split = time() - t0
+
+    exec_args = '-t {} -u 1 '.format(args.slots)
+    if steal:
+        exec_args += '-w '
+    if args.direct:
+        exec_args += '-x '
+    backend = backends.get('fake', max_concurrency=len(machine_list))
+    t0 = time()
+    dispatch.send_jobs(machine_list, work_dir, pool_dir, 'sim', backend, exec_args=exec_args, use_queue=use_queue)
+    t_send = time() - t0
+    records = wait_for_clients(pool_dir, len(machine_list), args.timeout)
+
+    # Everyone's last status update is when they finished
+    makespan = max(x['t_update'] for x in records) - t0
+    busy = 0.
+    for time_file in glob(join(pool_dir, '*.cmds.time')):
+        with open(time_file) as f:
+            busy += sum(float(l.split(' ', 1)[0]) for l in f if l.strip())
+    n_spawned = sum(x['done'] + x['failed'] for x in records)
+    return {
+        'strategy': name,
+        'makespan': makespan,
+        'idle': 1 - busy / (makespan * args.slots * len(machine_list)),
+        'tail': makespan - min(x['t_update'] for x in records) + t0,
+        'split': t_split,
+        'send': t_send,
+        'spawn': sum((x['mean_spawn'] or 0) * (x['done'] + x['failed']) for x in records) / max(n_spawned, 1),
+        'done': sum(x['done'] for x in records),
+    }
+
+
+def main(args):
+    rng = Random(args.seed)
+    durations = draw_durations(args.dist, args.jobs, rng)
+    n_slow = int(round(args.slow_frac * args.hosts))
+    speeds = {'sim%02d' % i: args.slow_speed if i < n_slow else 1. for i in range(args.hosts)}
+    # Nothing can finish before the total work is spread evenly, or before the longest job
+    lower_bound = max(sum(durations) / (args.slots * sum(speeds.values())), max(durations) / max(speeds.values()))
+    logging.info("%d jobs (%s; %.1fs in total, %.2fs max) on %d machines x %d slots, %d of them at %.2fx speed",
+                 len(durations), args.dist, sum(durations), max(durations), args.hosts, args.slots, n_slow,
+                 args.slow_speed)
+    logging.info("Lower bound on makespan: %.2fs", lower_bound)
+
+    work_dir = mkdtemp(prefix='bench_dispatch_') if args.work_dir is None else args.work_dir
+    makedirs(work_dir, exist_ok=True)
+    with open(join(work_dir, 'sim_job.py'), 'w') as f:
+        f.write(sim_job)
+    with open(join(work_dir, 'speeds.json'), 'w') as f:
+        json.dump(speeds, f)
+
+    results = []
+    try:
+        for name in args.strategies.split(','):
+            rmtree(join(work_dir, name), ignore_errors=True)
+            results.append(run_strategy(name, work_dir, durations, speeds, args))
+    finally:
+        if args.work_dir is None:
+            rmtree(work_dir, ignore_errors=True)
+
+    logging.info("%-18s %9s %9s %7s %8s %8s %9s %9s %6s", "strategy", "makespan", "vs bound", "idle", "tail",
+                 "split", "send", "spawn", "done")
+    for x in results:
+        logging.info("%-18s %8.2fs %8.2fx %6.1f%% %7.2fs %6.1fms %7.1fms %7.1fms %6d", x['strategy'],
+                     x['makespan'], x['makespan'] / lower_bound, 100 * x['idle'], x['tail'], 1000 * x['split'],
+                     1000 * x['send'], 1000 * x['spawn'], x['done'])
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Compare scheduling strategies on a simulated cluster of this machine")
+    parser.add_argument('--strategies', type=str, default=','.join(strategies),
+                        help="comma-separated, out of: %s" % ', '.join(strategies))
+    parser.add_argument('--jobs', type=int, default=200,
+                        help="number of jobs")
+    parser.add_argument('--dist', type=str, default='lognormal:-1.5,1',
+                        help=("distribution of job durations in seconds: const:<d>, uniform:<lo>,<hi>, "
+                              "exp:<mean>, lognormal:<mu>,<sigma> or pareto:<alpha>,<min>"))
+    parser.add_argument('--hosts', type=int, default=8,
+                        help="number of simulated machines")
+    parser.add_argument('--slots', type=int, default=2,
+                        help="jobs run at once per machine")
+    parser.add_argument('--slow_frac', type=float, default=0.25,
+                        help="fraction of machines that are slow")
+    parser.add_argument('--slow_speed', type=float, default=0.5,
+                        help="speed of slow machines relative to the rest")
+    parser.add_argument('--estimate_noise', type=float, default=0.,
+                        help="sigma of the log-normal error in runtime estimates for LPT; 0 for exact ones")
+    parser.add_argument('--direct', action='store_true',
+                        help="have exec_client spawn jobs directly, as with dispatch.py --exec_direct")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="random seed for job durations and estimate errors")
+    parser.add_argument('--timeout', type=int, default=600,
+                        help="seconds to wait for each strategy to finish")
+    parser.add_argument('--work_dir', type=str,
+                        help="where to keep pool_dirs for inspection; a temporary directory if not given")
+    main(parser.parse_args())
@@ -0,0 +1,42 @@
+"""
+Per-Job Directives
+
+A params line may start with `@key=value` tokens, e.g., `@mem=4G 1 2`, which
+are hints for dispatch.py and exec_client rather than arguments to the job.
+They are kept at the front of the command, as in `@mem=4G python job.py 1 2`,
+and stripped right before it's run.
+"""
+
+
+def split(line):
+    hints = {}
+    tokens = line.split(' ')
+    i = 0
+    while i < len(tokens) and tokens[i].startswith('@') and '=' in tokens[i]:
+        k, v = tokens[i][1:].split('=', 1)
+        hints[k] = v
+        i += 1
+    return hints, ' '.join(tokens[i:])
+
+
+def join(hints, cmd):
+    return ' '.join(['@%s=%s' % x for x in hints.items()] + [cmd])
+
+
+def priority(cmd):
+    # Jobs with higher @priority= start first; 0 if not given
+    return float(split(cmd)[0].get('priority', 0))
+
+
+def gpus(cmd):
+    # Number of GPUs the job needs, from @gpu=; 0 if not given
+    return int(split(cmd)[0].get('gpu', 0))
+
+
+def parse_size(size):
+    # In GB, e.g., '4G', '512M' or just '4'
+    units = {'K': 1. / 1024 ** 2, 'M': 1. / 1024, 'G': 1., 'T': 1024.}
+    size = size.upper().rstrip('B')
+    if size[-1] in units:
+        return float(size[:-1]) * units[size[-1]]
+    return float(size)
@@ -1,7 +1,13 @@
-from subprocess import call
 from random import shuffle
-from os import makedirs
+from heapq import heapify, heappush, heappop
+from statistics import mean, median
+from glob import glob
+from os import makedirs, remove
 from os.path import exists, join, dirname, realpath, basename, splitext
+from sys import argv
+from time import time, sleep
+from itertools import islice
+import json
 from shutil import rmtree
 from ast import literal_eval
 from argparse import ArgumentParser
@@ -9,58 +15,192 @@ from configparser import ConfigParser
 import logging
 from tqdm import tqdm
 import logging_colorer # noqa: F401 # pylint: disable=unused-import
+import job_queue
+import directives
+import job_logs
+import backends
 
 logging.basicConfig(level=logging.INFO)
 
 exec_client = join(dirname(realpath(__file__)), 'exec_client.py')
 
 
-def send_jobs(machine_list, curr_dir, pool_dir, prefix, dry_run=False, exec_args=''):
-    cmds = []
+def send_jobs(machine_list, curr_dir, pool_dir, prefix, backend, dry_run=False, exec_args='',
+              use_queue=False, cpu_hosts=()):
+    host_cmds = []
     for i, x in enumerate(machine_list):
-        cmds_file = join(pool_dir, '{}_{:09d}.cmds'.format(prefix, i))
-        expects_file = join(pool_dir, '{}_{:09d}.expects'.format(prefix, i))
-        cmd = 'ssh -f vision{} "cd {}; python {} {} {} {}"'.format(
-            x, curr_dir, exec_client, exec_args, cmds_file, expects_file)
-        cmds.append(cmd)
+        # Machines listed as CPU ones don't offer their GPUs, if any
+        host_args = '-g 0 ' if x in cpu_hosts else ''
+        if use_queue:
+            # Everyone pulls from the same queue
+            job_args = '-q {}'.format(join(pool_dir, '{}.queue'.format(prefix)))
+        else:
+            cmds_file = join(pool_dir, '{}_{:09d}.cmds'.format(prefix, i))
+            expects_file = join(pool_dir, '{}_{:09d}.expects'.format(prefix, i))
+            job_args = '{} {}'.format(cmds_file, expects_file)
+        out_file = join(pool_dir, '{}_{:09d}.out'.format(prefix, i))
+        cmd = backend.wrap(curr_dir, '{} {} {}{}{}'.format(
+            backend.python, exec_client, exec_args, host_args, job_args), out_file)
+        host_cmds.append((x, cmd))
     with open(join(pool_dir, 'ssh.cmds'), 'w') as f:
-        for x in cmds:
-            f.write(x + '\n')
+        for host, cmd in host_cmds:
+            f.write(backend.describe(host, cmd) + '\n')
     if dry_run:
-        for x in cmds:
-            logging.info("%s", x)
+        for host, cmd in host_cmds:
+            logging.info("%s", backend.describe(host, cmd))
     else:
-        for x in cmds:
-            call(x, shell=True)
-
-
-def split_jobs(cmds, cmd_expects, n_machines, pool_dir, prefix):
-    # Init
-    machine_cmds, machine_expects = [], []
-    for _ in range(n_machines):
-        machine_cmds.append([])
-        machine_expects.append([])
-    #
-    m_id = 0
-    for i, x in enumerate(cmds):
-        machine_cmds[m_id].append(x)
-        machine_expects[m_id].append(cmd_expects[i])
-        m_id += 1
-        if m_id >= n_machines:
-            m_id = 0
+        backend.launch(host_cmds)
+
+
+def write_jobs(placed, n_machines, pool_dir, prefix):
+    # Jobs are written out as they're placed, each as (machine index, (cmd, expects))
     logging.info("Generating commands for all machines into pool...")
-    for mi, thismachine_cmds in enumerate(tqdm(machine_cmds)):
-        outf = join(pool_dir, '{}_{:09d}.cmds'.format(prefix, mi))
-        with open(outf, 'w') as f:
-            for cmd in thismachine_cmds:
-                f.write(cmd + '\n')
-        outf = join(pool_dir, '{}_{:09d}.expects'.format(prefix, mi))
-        with open(outf, 'w') as f:
-            for es in machine_expects[mi]:
-                f.write(' '.join(es) + '\n')
-
-
-def gen_exec_args(args):
+    cmds_files, expects_files = [], []
+    try:
+        for mi in range(n_machines):
+            cmds_files.append(open(join(pool_dir, '{}_{:09d}.cmds'.format(prefix, mi)), 'w'))
+            expects_files.append(open(join(pool_dir, '{}_{:09d}.expects'.format(prefix, mi)), 'w'))
+        for mi, (cmd, expects) in tqdm(placed):
+            cmds_files[mi].write(cmd + '\n')
+            expects_files[mi].write(' '.join(expects) + '\n')
+    finally:
+        for f in cmds_files + expects_files:
+            f.close()
+
+
+def preferred_machines(cmd, index):
+    # Machines named by the job's @host= hint, e.g., @host=vision03,vision07
+    # for a job whose inputs are on those machines' scratch disks; None if
+    # there's no such hint
+    hosts = directives.split(cmd)[0].get('host')
+    if hosts is None:
+        return None
+    return [index[h] for h in hosts.split(',') if h in index]
+
+
+def machine_pools(machine_list, gpu_hosts):
+    # Machines that GPU jobs and other jobs, respectively, may go to: GPU
+    # machines and CPU machines, unless there are none of the kind
+    everyone = tuple(range(len(machine_list)))
+    gpu = tuple(mi for mi, x in enumerate(machine_list) if x in gpu_hosts)
+    cpu = tuple(mi for mi, x in enumerate(machine_list) if x not in gpu_hosts)
+    return gpu or everyone, cpu or everyone
+
+
+def job_pool(cmd, pools):
+    return pools[0] if directives.gpus(cmd) > 0 else pools[1]
+
+
+def place_jobs(jobs, loads, share, slack):
+    # Each job, given as (job, cost, preferred machines, machines allowed),
+    # goes to the allowed machine with the least work so far, or to the least
+    # loaded of its preferred ones unless that one is already ahead by over
+    # `slack` of an even share of all work; yields where each job goes,
+    # updating `loads`
+    heaps, heaps_of = {}, [[] for _ in loads]
+    n_pref, n_local, n_unknown = 0, 0, 0
+    for job, cost, prefs, pool in jobs:
+        if pool not in heaps:
+            heaps[pool] = [(loads[mi], mi) for mi in pool]
+            heapify(heaps[pool])
+            for mi in pool:
+                heaps_of[mi].append(heaps[pool])
+        heap = heaps[pool]
+        # Entries for loads since updated are stale
+        while heap[0][0] != loads[heap[0][1]]:
+            heappop(heap)
+        mi = heap[0][1]
+        if prefs is not None:
+            n_pref += 1
+            prefs = [x for x in prefs if x in pool]
+            if not prefs:
+                n_unknown += 1
+            else:
+                pi = min(prefs, key=lambda x: loads[x])
+                if loads[pi] <= loads[mi] + slack * share:
+                    mi = pi
+                    n_local += 1
+        loads[mi] += cost
+        for h in heaps_of[mi]:
+            heappush(h, (loads[mi], mi))
+        yield mi, job
+    if n_unknown > 0:
+        logging.warning("%d jobs prefer only machines not configured or of the wrong kind; "
+                        "placed them elsewhere", n_unknown)
+    if n_pref > 0:
+        logging.info("%d/%d jobs with a preference placed on a preferred machine", n_local, n_pref)
+
+
+def split_jobs(jobs, machine_list, pool_dir, prefix, n_jobs, slack=0.25, gpu_hosts=()):
+    # Round-robin, i.e., one job at a time to whoever has the fewest, except
+    # for jobs preferring certain machines or needing GPUs; jobs, as (cmd,
+    # expects), are streamed through, and `n_jobs` needn't be exact
+    index = {x: mi for mi, x in enumerate(machine_list)}
+    pools = machine_pools(machine_list, gpu_hosts)
+    loads = [0.] * len(machine_list)
+    placed = place_jobs(((x, 1., preferred_machines(x[0], index), job_pool(x[0], pools)) for x in jobs),
+                        loads, n_jobs / len(machine_list), slack)
+    write_jobs(placed, len(machine_list), pool_dir, prefix)
+
+
+def split_jobs_lpt(cmds, cmd_expects, est_runtimes, machine_list, pool_dir, prefix, slack=0.25, gpu_hosts=()):
+    # Longest processing time first: the next longest job goes to whichever
+    # machine (of the right kind) has the least predicted work so far
+    index = {x: mi for mi, x in enumerate(machine_list)}
+    pools = machine_pools(machine_list, gpu_hosts)
+    loads = [0.] * len(machine_list)
+    order = sorted(range(len(cmds)), key=lambda i: -est_runtimes[i])
+    placed = place_jobs((((cmds[i], cmd_expects[i]), est_runtimes[i], preferred_machines(cmds[i], index),
+                          job_pool(cmds[i], pools)) for i in order),
+                        loads, sum(est_runtimes) / len(machine_list), slack)
+    write_jobs(placed, len(machine_list), pool_dir, prefix)
+    logging.info("Predicted makespan: %.1f seconds", max(loads))
+
+
+def load_runtimes(runtimes_file):
+    runtimes = {}
+    if exists(runtimes_file):
+        with open(runtimes_file) as f:
+            for l in f:
+                t, params = l.rstrip('\n').split(' ', 1)
+                runtimes[params] = float(t)
+    return runtimes
+
+
+def harvest_runtimes(pool_dir, cmd_prefix, runtimes_file):
+    # Merge runtimes that exec_client recorded during the previous run into
+    # the history, before pool_dir gets wiped
+    runtimes = load_runtimes(runtimes_file)
+    time_files = glob(join(pool_dir, '*.cmds.time'))
+    for time_file in time_files:
+        with open(time_file) as f:
+            for l in f:
+                t, cmd = l.rstrip('\n').split(' ', 1)
+                cmd = directives.split(cmd)[1]
+                # Keyed by the params line, as long as the job itself is the same
+                if cmd.startswith(cmd_prefix + ' '):
+                    runtimes[cmd[len(cmd_prefix) + 1:]] = float(t)
+    if time_files:
+        with open(runtimes_file, 'w') as f:
+            for params, t in runtimes.items():
+                f.write('{:.3f} {}\n'.format(t, params))
+    return runtimes
+
+
+def estimate_runtimes(cmds, cmd_prefix, runtimes, default='median'):
+    params = [directives.split(x)[1][len(cmd_prefix) + 1:] for x in cmds]
+    known = [runtimes[x] for x in params if x in runtimes]
+    if default in ('mean', 'median', 'max'):
+        # Jobs without history are assumed to be typical of those with
+        fallback = {'mean': mean, 'median': median, 'max': max}[default](known) if known else 1.
+    else:
+        fallback = float(default)
+    logging.info("Runtime history found for %d/%d jobs; assuming %.1f seconds for the rest",
+                 len(known), len(params), fallback)
+    return [runtimes.get(x, fallback) for x in params]
+
+
+def gen_exec_args(args, pool_dir):
     exec_args = ''
     if args.exec_seg > 0:
         exec_args += '-s {} '.format(args.exec_seg)
@@ -68,29 +208,143 @@ def gen_exec_args(args):
         exec_args += '-t {} '.format(args.exec_thread)
     if args.exec_cap > 0:
         exec_args += '-c {} '.format(args.exec_cap)
+    if args.exec_lease > 0:
+        exec_args += '-l {} '.format(args.exec_lease)
+    if args.exec_steal:
+        exec_args += '-w '
+    if args.exec_manifest:
+        # Outside pool_dir, so that it survives the next dispatch
+        exec_args += '-m {} '.format(pool_dir.rstrip('/') + '.done')
+    if args.exec_retries > 0:
+        exec_args += '-r {} -b {} '.format(args.exec_retries, args.exec_backoff)
+    if args.exec_quarantine > 0:
+        exec_args += '-Q {} '.format(args.exec_quarantine)
+    if args.exec_direct:
+        exec_args += '-x '
+    if args.exec_adaptive:
+        exec_args += '-a '
+    if args.exec_mem > 0:
+        exec_args += '-M {} '.format(args.exec_mem)
+    if args.exec_gpus >= 0:
+        exec_args += '-g {} '.format(args.exec_gpus)
+    if args.exec_heartbeat > 0:
+        exec_args += '-u {} '.format(args.exec_heartbeat)
+    if args.exec_lease_time > 0:
+        exec_args += '-L {} '.format(args.exec_lease_time)
     if args.exec_dryrun:
         exec_args += '-d '
     return exec_args
 
 
-def gen_full_cmds(cmd_prefix, params_file, expect_file):
-    with open(params_file) as f:
-        params = f.readlines()
-    if expect_file is None:
-        expects = None
+def count_lines(path):
+    with open(path, 'rb') as f:
+        return sum(x.count(b'\n') for x in iter(lambda: f.read(1 << 20), b''))
+
+
+def iter_full_cmds(cmd_prefix, params_file, expect_file):
+    # One job, as (cmd, expects), at a time, so that sweeps of millions of
+    # lines are never held in memory all at once
+    f = open(params_file)
+    g = None if expect_file is None else open(expect_file)
+    try:
+        for x in f:
+            # Directives stay in front of the command, for exec_client to strip
+            hints, x = directives.split(x.strip())
+            cmd = directives.join(hints, '%s %s' % (cmd_prefix, x))
+            if g is None:
+                yield cmd, ['a-nonexistent-placeholder-file']
+            else:
+                expects = g.readline()
+                assert expects, "Lines of `expect_file` and `params_file` must correspond"
+                yield cmd, expects.strip().split(' ')
+        assert g is None or not g.readline(), "Lines of `expect_file` and `params_file` must correspond"
+    finally:
+        f.close()
+        if g is not None:
+            g.close()
+
+
+def fill_queue(jobs, queue_file, on_started=None, chunk_size=10000, gpu_routing=False):
+    # Jobs go in a chunk at a time, and clients may start pulling right after
+    # the first (see on_started), as the queue is marked as still filling
+    conn = job_queue.connect(queue_file)
+    job_queue.set_filling(conn, True)
+    # As with lists, GPU jobs go to GPU machines only if there are any
+    job_queue.set_gpu_routing(conn, gpu_routing)
+    n = 0
+    try:
+        while True:
+            chunk = list(islice(jobs, chunk_size))
+            if not chunk:
+                break
+            job_queue.add(conn, chunk)
+            if n == 0 and on_started is not None:
+                on_started()
+            n += len(chunk)
+    finally:
+        job_queue.set_filling(conn, False)
+        conn.close()
+    logging.info("%d jobs put into the queue", n)
+    if n == 0 and on_started is not None:
+        on_started()
+
+
+def retry_failed(machine_list, curr_dir, pool_dir, prefix, backend, args, exec_args, cpu_hosts=()):
+    queue_file = join(pool_dir, '%s.queue' % prefix)
+    use_queue = exists(queue_file)
+    if use_queue:
+        conn = job_queue.connect(queue_file)
+        n = job_queue.requeue_failed(conn, skip=job_logs.read_quarantine(pool_dir))
+        conn.close()
     else:
-        with open(expect_file) as f:
-            expects = f.readlines()
-        assert len(params) == len(expects), \
-            "Lines of `expect_file` and `params_file` must correspond"
-    cmds, cmd_expects = [], []
-    for i, x in enumerate(params):
-        cmds.append('%s %s' % (cmd_prefix, x.strip()))
-        if expects is None:
-            cmd_expects.append(['a-nonexistent-placeholder-file'])
-        else:
-            cmd_expects.append(expects[i].strip().split(' '))
-    return cmds, cmd_expects
+        # Each machine reruns what failed in its own log
+        n_lists = len(glob(join(pool_dir, prefix + '_' + '[0-9]' * 9 + '.cmds')))
+        if n_lists != len(machine_list):
+            logging.warning("Jobs were split among %d machines, but %d are configured now; "
+                            "only the first %d lists will be retried",
+                            n_lists, len(machine_list), min(n_lists, len(machine_list)))
+            machine_list = machine_list[:n_lists]
+        n = len(job_logs.outstanding_failures(glob(join(pool_dir, '*.cmds.log')),
+                                              glob(join(pool_dir, '*.cmds.time')),
+                                              job_logs.read_quarantine(pool_dir)))
+        exec_args += '--retry_failed '
+    logging.info("Retrying %d failed jobs", n)
+    send_jobs(machine_list, curr_dir, pool_dir, prefix, backend,
+              dry_run=args.dryrun,
+              exec_args=exec_args,
+              use_queue=use_queue,
+              cpu_hosts=cpu_hosts)
+
+
+def batch_jobs(jobs, cmd_prefix, batch_size, batch_dir):
+    # Params lines go into files of up to batch_size lines, each run by one
+    # process, which goes over them with xiuminglib.general.iter_batch();
+    # only lines with the same directives are batched together
+    makedirs(batch_dir)
+    batch, batch_hints = [], None
+    n_jobs, n_batches = 0, 0
+
+    def flush():
+        batch_file = join(batch_dir, '{:09d}.params'.format(n_batches))
+        with open(batch_file, 'w') as f:
+            for params, _ in batch:
+                f.write(params + '\n')
+        return (directives.join(batch_hints, '%s --dispatch_batch %s' % (cmd_prefix, batch_file)),
+                [f for _, expects in batch for f in expects])
+
+    for cmd, expects in jobs:
+        hints, x = directives.split(cmd)
+        if batch and (hints != batch_hints or len(batch) == batch_size):
+            yield flush()
+            n_batches += 1
+            batch = []
+        batch.append((x[len(cmd_prefix) + 1:], expects))
+        batch_hints = hints
+        n_jobs += 1
+    if batch:
+        yield flush()
+        n_batches += 1
+    logging.info("%d jobs batched into %d", n_jobs, n_batches)
 
 
 def main(args):
@@ -103,8 +357,35 @@ def main(args):
     cmd_prefix = '%s %s' % (config['JOB']['bin'], job_file)
     params_file = join(curr_dir, config['JOB']['params_file'])
     pool_dir = join(curr_dir, config['JOB']['pool_dir'])
+    if 'runtimes_file' in config['OPTIONAL']:
+        runtimes_file = join(curr_dir, config['OPTIONAL']['runtimes_file'])
+    else:
+        runtimes_file = pool_dir.rstrip('/') + '.runtimes'
+
+    # Machines
+    cpu_machines = [x for x in eval(config['MACHINES']['cpu'])]
+    shuffle(cpu_machines) # in-place
+    gpu_machines = [x for x in literal_eval(config['MACHINES']['gpu'])]
+    shuffle(gpu_machines) # in-place
+    cpu_hosts = ['vision%02d' % x for x in cpu_machines]
+    gpu_hosts = ['visiongpu%02d' % x for x in gpu_machines]
+    machine_list = cpu_hosts + gpu_hosts
+    backend = backends.get(args.backend, ssh=args.ssh, max_concurrency=args.ssh_jobs, timeout=args.ssh_timeout)
+    machine_list = backend.hosts(machine_list)
+
+    exec_args = gen_exec_args(args, pool_dir)
+
+    if args.retry_failed:
+        # Leave pool_dir as is and rerun only what failed
+        retry_failed(machine_list, curr_dir, pool_dir, job_name, backend, args, exec_args, cpu_hosts=cpu_hosts)
+        return
+
+    runtimes = harvest_runtimes(pool_dir, cmd_prefix, runtimes_file)
     rmtree(pool_dir, ignore_errors=True)
     makedirs(pool_dir)
+    # For the supervisor to start replacement clients the same way
+    with open(join(pool_dir, 'exec.args'), 'w') as f:
+        f.write(exec_args)
     if 'expect_file' in config['OPTIONAL']:
         expect_file = join(curr_dir, config['OPTIONAL']['expect_file'])
         if not exists(expect_file):
@@ -113,40 +394,305 @@ def main(args):
     else:
         expect_file = None
 
-    # Machines
-    cpu_machines = [x for x in eval(config['MACHINES']['cpu'])]
-    shuffle(cpu_machines) # in-place
-    gpu_machines = [x for x in literal_eval(config['MACHINES']['gpu'])]
-    shuffle(gpu_machines) # in-place
-    machine_list = []
-    for x in cpu_machines:
-        machine_list.append('%02d' % x)
-    for x in gpu_machines:
-        machine_list.append('gpu%02d' % x)
+    jobs = iter_full_cmds(cmd_prefix, params_file, expect_file)
+    n_jobs = count_lines(params_file)
+    if args.batch > 1:
+        jobs = batch_jobs(jobs, cmd_prefix, args.batch, join(pool_dir, '%s_batches' % job_name))
+        n_jobs = -(-n_jobs // args.batch)
 
-    cmds, cmd_expects = gen_full_cmds(cmd_prefix, params_file, expect_file)
+    def start_clients():
+        send_jobs(machine_list, curr_dir, pool_dir, job_name, backend,
+                  dry_run=args.dryrun,
+                  exec_args=exec_args,
+                  use_queue=args.queue,
+                  cpu_hosts=cpu_hosts)
 
-    exec_args = gen_exec_args(args)
+    queue_file = join(pool_dir, '%s.queue' % job_name)
+    gpu_routing = any(x in gpu_hosts for x in machine_list)
+    if args.schedule == 'lpt':
+        # Needs all jobs at once to sort them
+        cmds, cmd_expects = [], []
+        for cmd, expects in jobs:
+            cmds.append(cmd)
+            cmd_expects.append(expects)
+        est_runtimes = estimate_runtimes(cmds, cmd_prefix, runtimes, default=args.default_runtime)
+        if args.queue:
+            # Longest first, so that the queue drains evenly at the end
+            order = sorted(range(len(cmds)), key=lambda i: -est_runtimes[i])
+            logging.info("Putting commands into the job queue...")
+            fill_queue(((cmds[i], cmd_expects[i]) for i in order), queue_file, gpu_routing=gpu_routing)
+        else:
+            split_jobs_lpt(cmds, cmd_expects, est_runtimes, machine_list, pool_dir, job_name,
+                           slack=args.locality_slack, gpu_hosts=gpu_hosts)
+        start_clients()
+    elif args.queue:
+        logging.info("Putting commands into the job queue...")
+        if backend.detached:
+            # Clients get going on the first jobs while the rest are still being read
+            fill_queue(jobs, queue_file, on_started=start_clients, gpu_routing=gpu_routing)
+        else:
+            fill_queue(jobs, queue_file, gpu_routing=gpu_routing)
+            start_clients()
+    else:
+        split_jobs(jobs, machine_list, pool_dir, job_name, n_jobs, slack=args.locality_slack,
+                   gpu_hosts=gpu_hosts)
+        start_clients()
 
-    split_jobs(cmds, cmd_expects, len(machine_list), pool_dir, job_name)
 
-    send_jobs(machine_list, curr_dir, pool_dir, job_name,
-              dry_run=args.dryrun,
-              exec_args=exec_args)
+def status(args):
+    config = ConfigParser(inline_comment_prefixes='#')
+    config.read(args.config_file)
+    curr_dir = config['ENVIRONMENT']['curr_dir']
+    job_name = splitext(basename(config['JOB']['job_file']))[0]
+    pool_dir = join(curr_dir, config['JOB']['pool_dir'])
+
+    records = []
+    for status_file in sorted(glob(join(pool_dir, '*.status'))):
+        with open(status_file) as f:
+            records.append(json.load(f))
+    if not records:
+        logging.warning("No client has reported its status in %s yet", pool_dir)
+        return
 
+    now = time()
+    active = [x for x in records if not x['finished'] and now - x['t_update'] <= args.stale]
+    silent = [x for x in records if not x['finished'] and now - x['t_update'] > args.stale]
+    rates = sorted(x['jobs_per_min'] for x in active)
+    median_rate = rates[len(rates) // 2] if rates else 0.
 
-if __name__ == '__main__':
+    logging.info("%-16s %8s %8s %8s %8s %10s %10s %10s", "host", "done", "failed", "running",
+                 "jobs/min", "runtime", "spawn", "updated")
+    for x in records:
+        if x['finished']:
+            note = "finished"
+        elif x in silent:
+            note = "SILENT, host or client may be dead"
+        elif x['jobs_per_min'] < 0.5 * median_rate:
+            note = "STRAGGLER, under half the median rate"
+        else:
+            note = ""
+        logging.info("%-16s %8d %8d %8d %8.2f %9.1fs %8.1fms %9.0fs  %s", x['host'], x['done'], x['failed'],
+                     x['running'], x['jobs_per_min'], x['mean_runtime'] or 0,
+                     1000 * (x.get('mean_spawn') or 0), now - x['t_update'], note)
+
+    queue_file = join(pool_dir, '%s.queue' % job_name)
+    if exists(queue_file):
+        conn = job_queue.connect(queue_file)
+        counts = job_queue.counts(conn)
+        conn.close()
+        remaining = counts.get('pending', 0) + counts.get('running', 0)
+    else:
+        # Jobs stolen from a list are counted by the thief, so this is a slight overestimate
+        remaining = sum(max(x['total'] - x['done'] - x['failed'], 0) for x in records if not x['finished'])
+    throughput = sum(rates)
+    logging.info("%d done, %d failed, %d remaining, on %d/%d active machines",
+                 sum(x['done'] for x in records), sum(x['failed'] for x in records), remaining,
+                 len(active), len(records))
+    if throughput > 0:
+        logging.info("Cluster throughput %.1f jobs/min; ETA %.1f minutes", throughput, remaining / throughput)
+    elif remaining > 0:
+        logging.warning("Nothing is making progress")
+
+
+def supervise(args):
+    config = ConfigParser(inline_comment_prefixes='#')
+    config.read(args.config_file)
+    curr_dir = config['ENVIRONMENT']['curr_dir']
+    job_name = splitext(basename(config['JOB']['job_file']))[0]
+    pool_dir = join(curr_dir, config['JOB']['pool_dir'])
+    backend = backends.get(args.backend, ssh=args.ssh, max_concurrency=args.ssh_jobs, timeout=args.ssh_timeout)
+    with open(join(pool_dir, 'exec.args')) as f:
+        exec_args = f.read()
+    cpu_hosts = ['vision%02d' % x for x in eval(config['MACHINES']['cpu'])]
+    gpu_hosts = ['visiongpu%02d' % x for x in literal_eval(config['MACHINES']['gpu'])]
+    queue_file = join(pool_dir, '%s.queue' % job_name)
+    use_queue = exists(queue_file)
+
+    # Clients already taken care of, by status file and pid
+    handled = set()
+    # Lists waiting for a host to take them over, by status file, with their hosts
+    orphaned = {}
+    # Those already reported as having no one to go to
+    stuck = set()
+    n_launched = 0
+    while True:
+        records = {}
+        for status_file in glob(join(pool_dir, '*.status')):
+            with open(status_file) as f:
+                records[status_file] = json.load(f)
+        now = time()
+        dead = {f: x for f, x in records.items() if not x['finished'] and now - x['t_update'] > args.lease
+                and (f, x['pid']) not in handled}
+        alive = [x['host'] for x in records.values() if not x['finished'] and now - x['t_update'] <= args.lease]
+        # Hosts done with their own jobs first, as they have nothing else to do
+        healthy = sorted(set(x['host'] for x in records.values() if x['finished']) - set(alive)) + alive
+        for f, x in dead.items():
+            logging.warning("%s: no heartbeat for %.0fs, deemed dead", x['host'], now - x['t_update'])
+            handled.add((f, x['pid']))
+
+        host_cmds = []
+        if use_queue:
+            # Jobs whose leases expired go back to the queue for live clients to pick up
+            conn = job_queue.connect(queue_file)
+            n = job_queue.requeue_expired(conn)
+            counts = job_queue.counts(conn)
+            filling = job_queue.is_filling(conn)
+            conn.close()
+            if n > 0:
+                logging.info("Requeued %d jobs with expired leases", n)
+            if counts.get('pending', 0) > 0 and not alive and healthy:
+                # No one left to pick them up
+                host_cmds.append((healthy[0], '-q {}'.format(queue_file)))
+        else:
+            for f, x in dead.items():
+                orphaned[f] = x['host']
+            if dead:
+                # Claims (if stealing) of dead clients, on their own jobs or ones they stole, would
+                # otherwise keep those jobs from everyone; claim files hold their claimants' host and
+                # pid, so that those of other clients on the same hosts, e.g., replacements, are kept
+                dead_clients = set('%s:%d' % (x['host'], x['pid']) for x in dead.values())
+                for claim_file in glob(join(pool_dir, '*.claims', '*')):
+                    try:
+                        with open(claim_file) as f:
+                            if f.read() not in dead_clients:
+                                continue
+                        remove(claim_file)
+                    except OSError:
+                        continue # removed by its claimant meanwhile
+                    owner_file = dirname(claim_file)[:-len('.claims')] + '.status'
+                    owner = records.get(owner_file)
+                    if owner is not None and owner['finished']:
+                        # No one would come back for the job otherwise
+                        orphaned[owner_file] = owner['host']
+                    # Whereas with its owner still running, the job will be stolen by
+                    # whoever runs out of jobs first, such as the dead host's replacement
+            for f in sorted(orphaned):
+                # A GPU machine's list may hold GPU jobs, so it goes only to another
+                candidates = [x for x in healthy if x in gpu_hosts] if orphaned[f] in gpu_hosts else healthy
+                if not candidates:
+                    if f not in stuck:
+                        logging.error("No healthy %shost to take over the jobs of %s yet",
+                                      'GPU ' if orphaned[f] in gpu_hosts else '', orphaned[f])
+                        stuck.add(f)
+                    continue
+                cmds_file = f[:-len('.status')] + '.cmds'
+                expects_file = f[:-len('.status')] + '.expects'
+                host = candidates[(n_launched + len(host_cmds)) % len(candidates)]
+                host_cmds.append((host, '{} {}'.format(cmds_file, expects_file)))
+                del orphaned[f]
+
+        if host_cmds:
+            to_launch = []
+            for host, job_args in host_cmds:
+                out_file = join(pool_dir, '{}_supervised_{:04d}.out'.format(job_name, n_launched))
+                n_launched += 1
+                # Machines listed as CPU ones don't offer their GPUs, if any, as in send_jobs()
+                host_args = '-g 0 ' if host in cpu_hosts else ''
+                logging.info("Starting a replacement client on %s: %s", host, job_args)
+                to_launch.append((host, backend.wrap(curr_dir, '{} {} {}{}{}'.format(
+                    backend.python, exec_client, exec_args, host_args, job_args), out_file)))
+            backend.launch(to_launch)
+        elif use_queue and counts.get('pending', 0) == 0 and counts.get('running', 0) == 0 and not filling:
+            # Dead hosts' status files never say they're finished, but the queue does
+            logging.info("All jobs finished")
+            break
+        elif not use_queue and not orphaned and records and all(x['finished'] for x in records.values()):
+            logging.info("All clients finished")
+            break
+        sleep(args.interval)
+
+
+if __name__ == '__main__' and len(argv) > 1 and argv[1] == 'status':
+    parser = ArgumentParser(prog='dispatch.py status',
+                            description="Summarize the progress of dispatched jobs across machines")
+    parser.add_argument('config_file', type=str,
+                        help="path to the configuration file")
+    parser.add_argument('--stale', type=int, default=120,
+                        help="seconds without a status update after which a client is deemed dead")
+    status(parser.parse_args(argv[2:]))
+elif __name__ == '__main__' and len(argv) > 1 and argv[1] == 'supervise':
+    parser = ArgumentParser(prog='dispatch.py supervise',
+                            description=("Watch dispatched clients' heartbeats and hand the jobs of dead ones "
+                                         "to healthy machines, until all are finished"))
+    parser.add_argument('config_file', type=str,
+                        help="path to the configuration file")
+    parser.add_argument('--lease', type=int, default=600,
+                        help="seconds without a heartbeat after which a client is deemed dead (see --exec_lease_time)")
+    parser.add_argument('--interval', type=int, default=60,
+                        help="seconds between checks")
+    parser.add_argument('--backend', type=str, choices=['ssh', 'local', 'fake'], default='ssh',
+                        help="how to start replacement clients; same as for dispatching")
+    parser.add_argument('--ssh', type=str, default='ssh',
+                        help="command to reach machines with")
+    parser.add_argument('--ssh_jobs', type=int, default=32,
+                        help="maximum number of machines to connect to at once")
+    parser.add_argument('--ssh_timeout', type=int, default=30,
+                        help="seconds to wait for each machine before giving up on it")
+    supervise(parser.parse_args(argv[2:]))
+elif __name__ == '__main__':
     parser = ArgumentParser(description="Dispatch jobs to machines")
     parser.add_argument('config_file', type=str,
                         help="path to the configuration file")
     parser.add_argument('--dryrun', action='store_true',
                         help="print commands without executing them")
+    parser.add_argument('--backend', type=str, choices=['ssh', 'local', 'fake'], default='ssh',
+                        help=("where to run: on all machines over ssh, on just this machine, or on this "
+                              "machine pretending to be all machines, for testing"))
+    parser.add_argument('--ssh', type=str, default='ssh',
+                        help="command to reach machines with")
+    parser.add_argument('--ssh_jobs', type=int, default=32,
+                        help="maximum number of machines to connect to at once")
+    parser.add_argument('--ssh_timeout', type=int, default=30,
+                        help="seconds to wait for each machine before giving up on it")
+    parser.add_argument('--retry_failed', action='store_true',
+                        help="keep pool_dir and rerun only the jobs that failed last time")
+    parser.add_argument('--batch', type=int, default=1,
+                        help=("run this many params lines per process, for job scripts that go over "
+                              "them with xiuminglib.general.iter_batch()"))
+    parser.add_argument('--queue', action='store_true',
+                        help=("let machines pull jobs from a shared queue in pool_dir "
+                              "instead of splitting jobs among them beforehand"))
+    parser.add_argument('--schedule', type=str, choices=['roundrobin', 'lpt'], default='roundrobin',
+                        help=("how to order and split jobs: round-robin, or longest processing time first "
+                              "using runtimes recorded in previous runs"))
+    parser.add_argument('--default_runtime', type=str, default='median',
+                        help=("for --schedule lpt: runtime (in seconds) assumed for jobs never run before, "
+                              "or mean/median/max of the known runtimes"))
+    parser.add_argument('--locality_slack', type=float, default=0.25,
+                        help=("for jobs with a @host= hint: how far ahead of the least loaded machine, as a "
+                              "fraction of an even share of all work, a preferred machine may get before "
+                              "such jobs go elsewhere"))
     parser.add_argument('--exec_seg', type=int,
                         help="for exec_client: segment number for updating progress", default=-1)
     parser.add_argument('--exec_thread', type=int,
                         help="for exec_client: thread number", default=-1)
     parser.add_argument('--exec_cap', type=int,
                         help="for exec_client: cap the task list to test on small batches", default=-1)
+    parser.add_argument('--exec_lease', type=int,
+                        help="for exec_client: number of jobs to claim at a time", default=-1)
+    parser.add_argument('--exec_steal', action='store_true',
+                        help="for exec_client: steal unstarted jobs from other machines once done with own")
+    parser.add_argument('--exec_manifest', action='store_true',
+                        help="for exec_client: record completed jobs and skip them without checking next time")
+    parser.add_argument('--exec_retries', type=int, default=0,
+                        help="for exec_client: number of times to retry a failed job")
+    parser.add_argument('--exec_backoff', type=float, default=10,
+                        help="for exec_client: seconds before the first retry, doubling for each further one")
+    parser.add_argument('--exec_quarantine', type=int, default=-1,
+                        help="for exec_client: give up on jobs after this many failures, counting earlier runs")
+    parser.add_argument('--exec_direct', action='store_true',
+                        help="for exec_client: spawn jobs directly instead of through a shell in a pool worker")
+    parser.add_argument('--exec_adaptive', action='store_true',
+                        help="for exec_client: start jobs only as free memory and load allow")
+    parser.add_argument('--exec_mem', type=float, default=-1,
+                        help="for exec_client: GB of memory assumed for jobs without a @mem= hint")
+    parser.add_argument('--exec_gpus', type=int, default=-1,
+                        help=("for exec_client: number of GPUs on each GPU machine, e.g., to simulate some; "
+                              "detected if not given"))
+    parser.add_argument('--exec_heartbeat', type=int, default=-1,
+                        help="for exec_client: seconds between updates of its status file, i.e., heartbeats")
+    parser.add_argument('--exec_lease_time', type=int, default=-1,
+                        help="for exec_client: seconds a job claimed from a queue stays its own without a heartbeat")
     parser.add_argument('--exec_dryrun', action='store_true',
                         help="for exec_client: print commands without executing")
     main(parser.parse_args())
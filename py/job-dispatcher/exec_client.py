@@ -1,74 +1,718 @@
-from multiprocessing import Pool
-from subprocess import call
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+from subprocess import call, Popen, check_output, CalledProcessError, DEVNULL
+from shlex import split
+from threading import Thread
+from time import time, sleep
 from socket import gethostname
-from os.path import exists
+from os import O_CREAT, O_EXCL, O_WRONLY, makedirs, listdir, scandir, write, close, getpid, replace, \
+    getloadavg, environ
+from os import open as os_open
+from os.path import exists, basename, dirname, join, normpath
+from glob import glob
 from argparse import ArgumentParser
+from collections import deque, Counter
+from heapq import heappush, heappop
+from itertools import count
+from queue import Queue, Empty
+import json
 from tqdm import tqdm
 import logging
 import logging_colorer # noqa: F401 # pylint: disable=unused-import
+import job_queue
+import directives
+import job_logs
 
 logging.basicConfig(level=logging.INFO)
 
+tiebreak = count() # for jobs retried at the same time
 
-def wrapper(cmd):
-    s = call(cmd.strip(), shell=True)
-    return [s, cmd]
+# Overridable so that clients on one machine can pose as different machines,
+# as with fake_ssh.py
+this_host = environ.get('EXEC_CLIENT_HOST') or gethostname()
 
 
-def main(args):
-    with open(args.cmds_file) as f:
-        cmds_all = f.readlines()
-    with open(args.expects_file) as f:
-        expects_all = f.readlines()
+def wrapper(cmd, t_submit=None, env=None):
+    t0 = time()
+    s = call(cmd.strip(), shell=True, env=env)
+    return [s, cmd, time() - t0, t0 - (t_submit or t0)]
 
-    if args.t < 0:
-        p = Pool()
-    else:
-        p = Pool(args.t)
-
-    if args.c > 0:
-        cmds_all = cmds_all[0:args.c]
-    cmds = []
-    for i, x in enumerate(cmds_all):
-        for f in expects_all[i].strip().split(' '):
-            if not exists(f):
-                cmds.append(x)
-                # Found one file missing, need to re-run this job
+
+class PoolLauncher(object):
+    """
+    Runs each job through a shell in a pool worker
+    """
+    def __init__(self, n_workers):
+        self.p = Pool(n_workers)
+
+    def start(self, job_id, cmd, done, env=None):
+        # Overhead here is the time to get the job to a worker
+        self.p.apply_async(wrapper, (cmd, time(), env),
+                           callback=lambda s: done.put((job_id, s)))
+
+    def close(self):
+        self.p.close()
+        self.p.join()
+
+
+class DirectLauncher(object):
+    """
+    Spawns each job right from this process, without a shell unless the
+    command needs one, and waits for it on a thread
+    """
+    shell_chars = set('|&;<>()$`*?[]{}~\n')
+
+    def parse(self, cmd):
+        if self.shell_chars.intersection(cmd) or '=' in cmd.split(' ', 1)[0]:
+            # Pipes, redirections, globs, variables, env. assignments, etc.
+            return ['/bin/sh', '-c', cmd]
+        return split(cmd)
+
+    def start(self, job_id, cmd, done, env=None):
+        # Overhead here is the time to parse the command and spawn it
+        t0 = time()
+        try:
+            proc = Popen(self.parse(cmd), env=env)
+        except OSError:
+            done.put((job_id, [127, cmd, 0., time() - t0])) # as if from a shell
+            return
+        t_spawn = time() - t0
+        Thread(target=self.wait, args=(proc, job_id, cmd, t0, t_spawn, done), daemon=True).start()
+
+    @staticmethod
+    def wait(proc, job_id, cmd, t0, t_spawn, done):
+        s = proc.wait()
+        done.put((job_id, [s, cmd, time() - t0, t_spawn]))
+
+    def close(self):
+        pass
+
+
+def is_done(expects):
+    for f in expects:
+        if not exists(f):
+            # Found one file missing, need to re-run this job
+            return False
+    return True
+
+
+def list_dir(d):
+    try:
+        return d, {x.name for x in scandir(d)}
+    except FileNotFoundError:
+        return d, set()
+
+
+class DoneChecker(object):
+    """
+    Tells which jobs are already complete, first from the completion manifest,
+    then by listing each output directory once (over NFS, a listing costs
+    about as much as a single stat) rather than checking every file
+    """
+    def __init__(self, manifest_dir=None, n_threads=8):
+        self.n_threads = n_threads
+        self.manifest = set()
+        self.manifest_file = None
+        if manifest_dir is not None:
+            makedirs(manifest_dir, exist_ok=True)
+            # One file per host, so that no two hosts ever append to the same file
+            for manifest_file in glob(join(manifest_dir, '*.done')):
+                with open(manifest_file) as f:
+                    self.manifest.update(l.rstrip('\n') for l in f)
+            self.manifest_file = join(manifest_dir, this_host + '.done')
+
+    def check(self, jobs):
+        done = [True] * len(jobs)
+        todo = [i for i, (cmd, _) in enumerate(jobs) if cmd not in self.manifest]
+        if len(todo) == 1:
+            i = todo[0]
+            done[i] = is_done(jobs[i][1])
+        elif todo:
+            files = {i: [normpath(f) for f in jobs[i][1]] for i in todo}
+            dirs = {dirname(f) or '.' for i in todo for f in files[i]}
+            tp = ThreadPool(min(self.n_threads, len(dirs)))
+            listings = dict(tp.imap_unordered(list_dir, dirs))
+            tp.close()
+            for i in todo:
+                done[i] = all(basename(f) in listings[dirname(f) or '.'] for f in files[i])
+        self.record([jobs[i][0] for i in todo if done[i]])
+        return done
+
+    def record(self, cmds):
+        if self.manifest_file is None or not cmds:
+            return
+        self.manifest.update(cmds)
+        with open(self.manifest_file, 'a') as f:
+            for x in cmds:
+                f.write(x + '\n')
+
+
+class ListSource(object):
+    """
+    Jobs from this machine's own cmds_file and expects_file
+    """
+    def __init__(self, cmds_file, expects_file, checker, cap=-1):
+        with open(cmds_file) as f:
+            cmds_all = f.readlines()
+        with open(expects_file) as f:
+            expects_all = f.readlines()
+        if cap > 0:
+            cmds_all = cmds_all[0:cap]
+        jobs = [(x.strip(), expects_all[i].strip().split(' ')) for i, x in enumerate(cmds_all)]
+        done = checker.check(jobs)
+        # Highest priority first, in order otherwise
+        self.jobs = deque(sorted(((i, x[0], x[1]) for i, x in enumerate(jobs) if not done[i]),
+                                 key=lambda x: -directives.priority(x[1])))
+        self.checker = checker
+        self.set_files(cmds_file)
+
+    def set_files(self, cmds_file):
+        self.log_file = cmds_file.replace('.cmds', '.cmds.log')
+        self.time_file = cmds_file.replace('.cmds', '.cmds.time')
+        self.status_file = cmds_file.replace('.cmds', '.status')
+        self.quarantine_file = cmds_file.replace('.cmds', '.quarantine')
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def peek(self):
+        return [x[1] for x in self.jobs]
+
+    def claim(self, n):
+        claimed = []
+        while self.jobs and len(claimed) < n:
+            claimed.append(self.jobs.popleft())
+        return claimed
+
+    def finish(self, job_id, status):
+        pass
+
+    def release(self, job_ids):
+        pass
+
+    def renew(self, job_ids):
+        pass
+
+    def lingers(self):
+        return False
+
+    def close(self):
+        pass
+
+
+class RetrySource(ListSource):
+    """
+    Only the jobs that this machine logged as failed (and that haven't succeeded
+    since), straight from its log, without checking any expected outputs
+    """
+    def __init__(self, cmds_file, checker, quarantine=()): # pylint: disable=super-init-not-called
+        self.set_files(cmds_file)
+        failed = job_logs.outstanding_failures([self.log_file], [self.time_file], quarantine)
+        self.jobs = deque(sorted(((i, x, []) for i, x in enumerate(failed)),
+                                 key=lambda x: -directives.priority(x[1])))
+        self.checker = checker
+
+
+class StealingSource(ListSource):
+    """
+    Same as ListSource, but every job is claimed by atomically creating a claim
+    file before it's run, and once done with its own list, this machine claims
+    unstarted jobs from the end of other machines' lists (but no GPU jobs if it
+    has no GPUs to give them)
+    """
+    def __init__(self, cmds_file, expects_file, checker, cap=-1, n_gpus=None):
+        super(StealingSource, self).__init__(cmds_file, expects_file, checker, cap=cap)
+        self.cmds_file = cmds_file
+        self.hostname = this_host
+        # Written into claim files, as in the status file, so that a dead client's claims can be
+        # told from those of others on the same machine
+        self.claimant = '%s:%d' % (this_host, getpid())
+        self.n_gpus = n_gpus
+        self.victims = None # loaded lazily once we run dry
+
+    @staticmethod
+    def claims_dir(cmds_file):
+        return cmds_file.replace('.cmds', '.claims')
+
+    def try_claim(self, cmds_file, i):
+        claim_file = join(self.claims_dir(cmds_file), '%09d' % i)
+        # O_EXCL creation is atomic (also on NFSv3+), so only one host wins
+        try:
+            fd = os_open(claim_file, O_CREAT | O_EXCL | O_WRONLY)
+        except FileExistsError:
+            return False
+        except FileNotFoundError:
+            makedirs(dirname(claim_file), exist_ok=True)
+            return self.try_claim(cmds_file, i)
+        write(fd, self.claimant.encode())
+        close(fd)
+        return True
+
+    def load_victims(self):
+        prefix = basename(self.cmds_file).rsplit('_', 1)[0]
+        self.victims = []
+        for cmds_file in sorted(glob(join(dirname(self.cmds_file), prefix + '_' + '[0-9]' * 9 + '.cmds'))):
+            if cmds_file == self.cmds_file:
+                continue
+            with open(cmds_file) as f:
+                cmds = f.readlines()
+            with open(cmds_file.replace('.cmds', '.expects')) as f:
+                expects = f.readlines()
+            # In the order its owner runs them
+            order = sorted(range(len(cmds)), key=lambda i: -directives.priority(cmds[i]))
+            self.victims.append([cmds_file, cmds, expects, len(cmds) - 1, order])
+
+    def n_unclaimed(self, victim):
+        claims_dir = self.claims_dir(victim[0])
+        n_claims = len(listdir(claims_dir)) if exists(claims_dir) else 0
+        return min(len(victim[1]) - n_claims, victim[3] + 1)
+
+    def steal(self, n):
+        if self.victims is None:
+            self.load_victims()
+        stolen = []
+        while len(stolen) < n and self.victims:
+            # Help whoever has the most work left, walking backwards from the
+            # end of its list so that we rarely collide with its owner
+            victim = max(self.victims, key=self.n_unclaimed)
+            cmds_file, cmds, expects_all, i, order = victim
+            while i >= 0 and len(stolen) < n:
+                j = order[i]
+                job = (cmds[j].strip(), expects_all[j].strip().split(' '))
+                if self.n_gpus == 0 and directives.gpus(job[0]) > 0:
+                    i -= 1
+                    continue
+                if not exists(join(self.claims_dir(cmds_file), '%09d' % j)) \
+                        and self.try_claim(cmds_file, j) and not self.checker.check([job])[0]:
+                    stolen.append(((cmds_file, j),) + job)
+                i -= 1
+            victim[3] = i
+            if i < 0:
+                self.victims.remove(victim)
+        return stolen
+
+    def claim(self, n):
+        claimed = []
+        while self.jobs and len(claimed) < n:
+            job = self.jobs.popleft()
+            if self.try_claim(self.cmds_file, job[0]):
+                claimed.append(job)
+        if len(claimed) < n:
+            claimed += self.steal(n - len(claimed))
+        return claimed
+
+
+class QueueSource(object):
+    """
+    Jobs pulled from the job queue shared by all machines
+    """
+    def __init__(self, queue_file, checker, cap=-1, lease=600, n_gpus=None):
+        self.conn = job_queue.connect(queue_file)
+        self.checker = checker
+        self.lease = lease
+        self.n_gpus = n_gpus
+        self.cap = cap
+        self.n_claimed = 0
+        self.hostname = this_host
+        self.log_file = queue_file.replace('.queue', '_%s.cmds.log' % self.hostname)
+        self.time_file = queue_file.replace('.queue', '_%s.cmds.time' % self.hostname)
+        self.status_file = queue_file.replace('.queue', '_%s.status' % self.hostname)
+        self.quarantine_file = queue_file.replace('.queue', '_%s.quarantine' % self.hostname)
+
+    def __len__(self):
+        n = job_queue.counts(self.conn).get('pending', 0)
+        return min(n, self.cap) if self.cap > 0 else n
+
+    def peek(self):
+        return job_queue.peek(self.conn, self.cap)
+
+    def claim(self, n):
+        claimed = []
+        while True:
+            n_more = n - len(claimed)
+            if self.cap > 0:
+                n_more = min(n_more, self.cap - self.n_claimed)
+            if n_more <= 0:
                 break
+            jobs = job_queue.claim(self.conn, self.hostname, n_more, lease=self.lease, max_gpus=self.n_gpus)
+            if not jobs and job_queue.requeue_expired(self.conn) > 0:
+                # Someone's claims expired, so their jobs are up for grabs again
+                continue
+            if not jobs:
+                break
+            self.n_claimed += len(jobs)
+            done = self.checker.check([x[1:] for x in jobs])
+            for i, job in enumerate(jobs):
+                if done[i]:
+                    job_queue.finish(self.conn, job[0], 0)
+                else:
+                    claimed.append(job)
+        return claimed
+
+    def finish(self, job_id, status):
+        job_queue.finish(self.conn, job_id, status)
+
+    def release(self, job_ids):
+        job_queue.release(self.conn, job_ids)
+
+    def renew(self, job_ids):
+        job_queue.renew(self.conn, job_ids, lease=self.lease)
+
+    def lingers(self):
+        # Jobs still running elsewhere may come back if their host dies, and
+        # more may be on their way if the queue is still filling
+        return self.cap <= 0 and (job_queue.is_filling(self.conn) or
+                                  job_queue.counts(self.conn).get('running', 0) > 0)
+
+    def close(self):
+        self.conn.close()
+
+
+class StatusWriter(object):
+    """
+    Periodically dumps this client's progress into pool_dir, for
+    `dispatch.py status` to aggregate across machines
+    """
+    def __init__(self, status_file, hostname, n_total, period=30):
+        self.status_file = status_file
+        self.period = period
+        self.t_written = 0
+        self.runtime_sum = 0.
+        self.spawn_sum, self.n_spawned = 0., 0
+        self.status = {
+            'host': hostname, 'pid': getpid(), 't_start': time(), 't_update': None,
+            'total': n_total, 'done': 0, 'failed': 0, 'running': 0,
+            'jobs_per_min': 0., 'mean_runtime': None, 'mean_spawn': None, 'finished': False}
+
+    def spawned(self, t_spawn):
+        self.spawn_sum += t_spawn
+        self.n_spawned += 1
+        self.status['mean_spawn'] = self.spawn_sum / self.n_spawned
+
+    def add(self, status, runtime):
+        if status == 0:
+            self.status['done'] += 1
+            self.runtime_sum += runtime
+            self.status['mean_runtime'] = self.runtime_sum / self.status['done']
+        else:
+            self.status['failed'] += 1
+
+    def write(self, n_running, finished=False):
+        now = time()
+        if not finished and now - self.t_written < self.period:
+            return False
+        n_finished = self.status['done'] + self.status['failed']
+        self.status.update({
+            't_update': now, 'running': n_running, 'finished': finished,
+            'jobs_per_min': 60 * n_finished / max(now - self.status['t_start'], 1e-6)})
+        # Written to the side and renamed, so that readers never see half a file
+        with open(self.status_file + '.tmp', 'w') as f:
+            json.dump(self.status, f)
+        replace(self.status_file + '.tmp', self.status_file)
+        self.t_written = now
+        return True
+
+
+class Admission(object):
+    """
+    Decides whether another job may start: here, simply up to a fixed number
+    """
+    def __init__(self, n_max):
+        self.n_max = n_max
+        self.poll = None # only ever blocked by running jobs, so no need to poll
+
+    def allows(self, n_running, hints):
+        return n_running < self.n_max
+
+    def started(self, hints):
+        pass
+
+
+class AdaptiveAdmission(Admission):
+    """
+    Starts another job only if there are idle cores and enough free memory
+    for it, going by its @mem= hint, or mem_per_job GB if it has none
+    """
+    def __init__(self, n_max, mem_per_job=1., mem_reserve=1., ramp=10):
+        super(AdaptiveAdmission, self).__init__(n_max)
+        self.n_cores = cpu_count()
+        self.mem_per_job = mem_per_job
+        self.mem_reserve = mem_reserve
+        self.ramp = ramp
+        self.recent = deque()
+        self.poll = 2
+
+    @staticmethod
+    def free_mem():
+        with open('/proc/meminfo') as f:
+            for l in f:
+                if l.startswith('MemAvailable:'):
+                    return int(l.split()[1]) / 1024. ** 2 # kB to GB
+        raise ValueError("MemAvailable not found in /proc/meminfo")
+
+    def mem_need(self, hints):
+        if 'mem' in hints:
+            return directives.parse_size(hints['mem'])
+        return self.mem_per_job
+
+    def allows(self, n_running, hints):
+        if n_running >= self.n_max:
+            return False
+        if n_running == 0:
+            # Anything is better than nothing
+            return True
+        # Load average already includes our jobs (give or take), so what's on
+        # top of them is someone else's
+        load_others = max(getloadavg()[0] - n_running, 0)
+        if n_running + 1 > self.n_cores - load_others:
+            return False
+        # Jobs that just started may not have allocated their memory yet
+        now = time()
+        while self.recent and now - self.recent[0][0] > self.ramp:
+            self.recent.popleft()
+        mem_pending = sum(x[1] for x in self.recent)
+        return self.free_mem() - mem_pending - self.mem_reserve >= self.mem_need(hints)
+
+    def started(self, hints):
+        self.recent.append((time(), self.mem_need(hints)))
 
-    hostname = gethostname()
-    log_file = args.cmds_file.replace('.cmds', '.cmds.log')
-    with open(log_file, 'a') as f:
-        f.write("Host: %s\n\n" % hostname)
+
+def detect_gpus():
+    # By CUDA's numbering, as jobs will see them
+    visible = environ.get('CUDA_VISIBLE_DEVICES')
+    if visible is not None:
+        return [x for x in visible.split(',') if x]
+    try:
+        out = check_output(['nvidia-smi', '-L'], stderr=DEVNULL).decode()
+    except (OSError, CalledProcessError):
+        return []
+    return [str(i) for i, l in enumerate(out.splitlines()) if l.startswith('GPU ')]
+
+
+class GpuSlots(object):
+    """
+    Hands out this machine's GPUs, through CUDA_VISIBLE_DEVICES, one job per
+    device, to jobs asking for some with @gpu=; other jobs see none
+    """
+    def __init__(self, devices):
+        self.devices = list(devices)
+        self.free = list(devices)
+        self.held = {}
+
+    @staticmethod
+    def need(hints):
+        return int(hints.get('gpu', 0))
+
+    def fits(self, hints):
+        # Jobs asking for more than there are get all there are
+        return len(self.free) >= min(self.need(hints), len(self.devices))
+
+    def acquire(self, job_id, hints):
+        if not self.devices:
+            return None
+        n = min(self.need(hints), len(self.devices))
+        if self.need(hints) > n:
+            logging.warning("Job %s asks for %d GPUs, but there are only %d", job_id, self.need(hints), n)
+        self.held[job_id], self.free = self.free[:n], self.free[n:]
+        return dict(environ, CUDA_VISIBLE_DEVICES=','.join(self.held[job_id]))
+
+    def release(self, job_id):
+        self.free += self.held.pop(job_id, [])
+
+
+def run_jobs(source, launcher, admission, hostname, lease=1, every=1, status_period=30,
+             retries=0, backoff=10, quarantine_after=-1, failures=None, quarantine=(), gpus=None):
+    # Jobs are claimed only when a worker is about to be free, so that
+    # whoever is fastest ends up running the most
+    done = Queue()
+    gpus = GpuSlots([]) if gpus is None else gpus
+    leased, running = deque(), {}
+    # Failed jobs waiting to be retried, by when
+    retrying, attempts = [], {}
+    failures = Counter() if failures is None else failures
+    quarantine = set(quarantine)
+    status = StatusWriter(source.status_file, hostname, len(source), period=status_period)
+    status.write(0)
+
+    def heartbeat():
+        # The status file doubles as our heartbeat, and leases on the jobs we
+        # hold (in a queue) are renewed along with it
+        if status.write(len(running)):
+            source.renew(list(running) + [x[0] for x in leased] + [x[2][0] for x in retrying])
+
+    try:
+        with tqdm(total=int(status.status['total'] / every), desc=hostname) as pbar:
+            cnt = 0
+            while True:
+                while True:
+                    if retrying and retrying[0][0] <= time():
+                        job = retrying[0][2]
+                    else:
+                        if not leased:
+                            leased.extend(source.claim(lease))
+                            if not leased:
+                                break
+                        job = leased[0]
+                    job_id, cmd, _ = job
+                    hints, bare_cmd = directives.split(cmd)
+                    if cmd not in quarantine and not (admission.allows(len(running), hints) and gpus.fits(hints)):
+                        break
+                    if retrying and job is retrying[0][2]:
+                        heappop(retrying)
+                    else:
+                        leased.popleft()
+                    if cmd in quarantine:
+                        source.finish(job_id, -1)
+                        continue
+                    launcher.start(job_id, bare_cmd, done, env=gpus.acquire(job_id, hints))
+                    admission.started(hints)
+                    running[job_id] = job
+                if not running and not retrying:
+                    if not source.lingers():
+                        break
+                    # Nothing to do for now, but some jobs may come back
+                    sleep(status_period)
+                    heartbeat()
+                    continue
+                # Wake up every now and then to report we're still alive, to
+                # see if there's room for more jobs now, or to retry one
+                timeout = min(status_period, admission.poll or status_period)
+                # A retry already due is waiting for room, like any other job, so it's only one
+                # still to come due that cuts the wait short
+                if retrying:
+                    until_retry = retrying[0][0] - time()
+                    if until_retry > 0:
+                        timeout = min(timeout, until_retry)
+                try:
+                    job_id, s = done.get(timeout=timeout)
+                except Empty:
+                    heartbeat()
+                    continue
+                job = running.pop(job_id)
+                gpus.release(job_id)
+                cmd = job[1]
+                status.spawned(s[3])
+                if s[0] == 0:
+                    source.checker.record([cmd])
+                    # Runtimes of successful jobs, for dispatch.py to schedule by next time
+                    with open(source.time_file, 'a') as f:
+                        f.write('{:.3f} {}\n'.format(s[2], cmd))
+                else:
+                    with open(source.log_file, 'a') as f:
+                        f.write('{}: {}\n'.format(cmd, s[0]))
+                    failures[cmd] += 1
+                    attempts[job_id] = attempts.get(job_id, 0) + 1
+                    if 0 < quarantine_after <= failures[cmd]:
+                        # Failed too many times, here or in earlier runs, so give up on it
+                        quarantine.add(cmd)
+                        with open(source.quarantine_file, 'a') as f:
+                            f.write(cmd + '\n')
+                    elif attempts[job_id] <= retries:
+                        delay = backoff * 2 ** (attempts[job_id] - 1)
+                        heappush(retrying, (time() + delay, next(tiebreak), job))
+                        heartbeat()
+                        continue
+                source.finish(job_id, s[0])
+                status.add(s[0], s[2])
+                heartbeat()
+                cnt += 1
+                if cnt % every == 0:
+                    pbar.update()
+    finally:
+        # Hand whatever we haven't finished back to the other clients
+        source.release(list(running) + [x[0] for x in leased] + [x[2][0] for x in retrying])
+        status.write(0, finished=True)
+        if status.n_spawned > 0:
+            logging.info("(%s) Mean spawn overhead: %.2f ms over %d jobs",
+                         hostname, 1000 * status.status['mean_spawn'], status.n_spawned)
+
+
+def main(args):
+    hostname = this_host
+
+    checker = DoneChecker(manifest_dir=args.m, n_threads=args.k)
+    pool_dir = dirname(args.queue or args.cmds_file)
+    quarantine = job_logs.read_quarantine(pool_dir)
+    gpus = GpuSlots(detect_gpus() if args.g < 0 else [str(i) for i in range(args.g)])
+    if args.queue is not None:
+        source = QueueSource(args.queue, checker, cap=args.c, lease=args.L, n_gpus=len(gpus.devices))
+    elif args.retry_failed:
+        source = RetrySource(args.cmds_file, checker, quarantine=quarantine)
+    elif args.w:
+        source = StealingSource(args.cmds_file, args.expects_file, checker, cap=args.c, n_gpus=len(gpus.devices))
+    else:
+        source = ListSource(args.cmds_file, args.expects_file, checker, cap=args.c)
 
     if args.d:
-        for x in cmds:
+        for x in source.peek():
             logging.info("(%s) %s", hostname, x)
+        source.close()
         return
 
-    with tqdm(total=int(len(cmds) / args.e), desc=hostname) as pbar:
-        cnt = 0
-        for i, s in enumerate(p.imap_unordered(wrapper, cmds)):
-            if s[0] != 0:
-                with open(log_file, 'a') as f:
-                    f.write('{}: {}\n'.format(s[1], s[0]))
-            cnt += 1
-            if cnt % args.e == 0:
-                pbar.update()
+    with open(source.log_file, 'a') as f:
+        f.write("Host: %s\n\n" % hostname)
+
+    n_workers = cpu_count() if args.t < 0 else args.t
+    if args.x:
+        launcher = DirectLauncher()
+    else:
+        launcher = PoolLauncher(n_workers)
+    if args.a:
+        admission = AdaptiveAdmission(n_workers, mem_per_job=args.M)
+    else:
+        admission = Admission(n_workers)
+
+    if args.Q > 0:
+        failures = job_logs.read_failures(glob(join(pool_dir, '*.cmds.log')))
+    else:
+        failures = None
+    run_jobs(source, launcher, admission, hostname, lease=args.l, every=args.e, status_period=args.u,
+             retries=args.r, backoff=args.b, quarantine_after=args.Q, failures=failures,
+             quarantine=quarantine, gpus=gpus)
 
-    pbar.close()
-    p.close()
-    p.join()
+    source.close()
+    launcher.close()
 
 
 if __name__ == '__main__':
     parser = ArgumentParser()
-    parser.add_argument('cmds_file', type=str, help="path to cmds_file")
-    parser.add_argument('expects_file', type=str, help="path to expects_file")
+    parser.add_argument('cmds_file', type=str, nargs='?', help="path to cmds_file")
+    parser.add_argument('expects_file', type=str, nargs='?', help="path to expects_file")
+    parser.add_argument('-q', '--queue', type=str,
+                        help="path to a job queue to pull from instead of cmds_file and expects_file")
+    parser.add_argument('-l', type=int,
+                        help="number of jobs to claim at a time", default=1)
+    parser.add_argument('-L', type=int,
+                        help="seconds a job claimed from a queue stays ours without a heartbeat (every -u seconds)", default=600)
+    parser.add_argument('-w', action='store_true',
+                        help="steal unstarted jobs from other machines' lists once done with own")
+    parser.add_argument('-m', type=str,
+                        help="directory of completion manifests, to skip jobs completed before without checking")
+    parser.add_argument('-k', type=int,
+                        help="number of threads for checking expected outputs", default=8)
+    parser.add_argument('-r', type=int,
+                        help="number of times to retry a failed job", default=0)
+    parser.add_argument('-b', type=float,
+                        help="seconds before the first retry, doubling for each further one", default=10)
+    parser.add_argument('-Q', type=int,
+                        help="give up on jobs after N failures, counting earlier runs", default=-1)
+    parser.add_argument('--retry_failed', action='store_true',
+                        help="rerun only the failures logged for cmds_file, without checking expected outputs")
+    parser.add_argument('-a', action='store_true',
+                        help="adaptive: start jobs only as free memory and load allow, up to -t at once")
+    parser.add_argument('-M', type=float,
+                        help="GB of memory assumed for jobs without a @mem= hint, with -a", default=1)
+    parser.add_argument('-x', action='store_true',
+                        help="spawn jobs directly instead of through a shell in a pool worker")
     parser.add_argument('-t', type=int,
                         help="number of threads per machine", default=-1)
+    parser.add_argument('-g', type=int,
+                        help="number of GPUs, one job each, e.g., to simulate some; detected if negative",
+                        default=-1)
     parser.add_argument('-e', type=int,
                         help="every N tasks to update progress bar once", default=1)
+    parser.add_argument('-u', type=int,
+                        help="every N seconds to update the status file in pool_dir", default=30)
     parser.add_argument('-c', type=int,
                         help="cap the task list to test on small batches", default=-1)
     parser.add_argument('-d', action='store_true',
@@ -0,0 +1,29 @@
+"""
+Stand-in for ssh that runs the command on this machine instead, to try out
+dispatching without a cluster; see `dispatch.py --backend fake`
+"""
+
+import sys
+from os import environ
+from subprocess import call
+
+# ssh options that take a value
+opts_with_value = 'BbcDEeFIiJLlmOopQRSWw'
+
+args = sys.argv[1:]
+no_cmd = False
+while args and args[0].startswith('-'):
+    opt = args.pop(0)
+    for i, c in enumerate(opt[1:]):
+        if c in ('N', 'O'):
+            # No remote command or a control command: pretend it went well
+            no_cmd = True
+        if c in opts_with_value:
+            if i == len(opt) - 2:
+                args.pop(0)
+            break
+host = args.pop(0) # always this machine, but exec_client takes on its name
+
+if no_cmd:
+    sys.exit(0)
+sys.exit(call(' '.join(args), shell=True, env=dict(environ, EXEC_CLIENT_HOST=host)))
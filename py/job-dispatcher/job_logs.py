@@ -0,0 +1,44 @@
+"""
+Reading Back What exec_client Logged in pool_dir
+
+`<prefix>*.cmds.log` has a `<cmd>: <exit status>` line per failed attempt,
+`<prefix>*.cmds.time` a `<runtime> <cmd>` line per success, and
+`<prefix>*.quarantine` a line per command given up on for failing too often.
+"""
+
+from collections import Counter
+from glob import glob
+from os.path import join
+
+
+def read_failures(log_files):
+    failures = Counter() # in order of first failure
+    for log_file in log_files:
+        with open(log_file) as f:
+            for l in f:
+                cmd, _, status = l.rstrip('\n').rpartition(': ')
+                if cmd and status.lstrip('-').isdigit():
+                    failures[cmd] += 1
+    return failures
+
+
+def read_successes(time_files):
+    successes = set()
+    for time_file in time_files:
+        with open(time_file) as f:
+            successes.update(l.rstrip('\n').split(' ', 1)[1] for l in f)
+    return successes
+
+
+def read_quarantine(pool_dir):
+    quarantine = set()
+    for quarantine_file in glob(join(pool_dir, '*.quarantine')):
+        with open(quarantine_file) as f:
+            quarantine.update(l.rstrip('\n') for l in f)
+    return quarantine
+
+
+def outstanding_failures(log_files, time_files, quarantine):
+    # Failed at some point, never succeeded since, and not given up on
+    successes = read_successes(time_files)
+    return [x for x in read_failures(log_files) if x not in successes and x not in quarantine]
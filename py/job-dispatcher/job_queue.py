@@ -0,0 +1,155 @@
+"""
+Job Queue Shared by All exec_client Instances
+
+A single SQLite file in `pool_dir`; clients claim pending jobs a few at a time,
+so faster hosts simply end up running more of them. No server is needed, only
+working file locks on the filesystem holding `pool_dir`.
+"""
+
+import sqlite3
+from time import time
+import directives
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    cmd TEXT NOT NULL,
+    expects TEXT NOT NULL,
+    priority REAL NOT NULL DEFAULT 0,
+    gpus INTEGER NOT NULL DEFAULT 0,
+    state TEXT NOT NULL DEFAULT 'pending',
+    host TEXT,
+    status INTEGER,
+    t_start REAL,
+    t_end REAL,
+    lease REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, priority DESC, id);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+'''
+
+
+def connect(queue_file):
+    # Autocommit mode so that we control transactions explicitly; the default
+    # rollback journal (not WAL) is used because WAL doesn't work over NFS
+    conn = sqlite3.connect(queue_file, timeout=600, isolation_level=None)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def create(queue_file, cmds, cmd_expects):
+    conn = connect(queue_file)
+    add(conn, zip(cmds, cmd_expects))
+    conn.close()
+
+
+def add(conn, jobs):
+    # Jobs as (cmd, expects) pairs, in one transaction
+    conn.execute('BEGIN IMMEDIATE')
+    conn.executemany(
+        'INSERT INTO jobs (cmd, expects, priority, gpus) VALUES (?, ?, ?, ?)',
+        ((cmd, ' '.join(expects), directives.priority(cmd), directives.gpus(cmd)) for cmd, expects in jobs))
+    conn.execute('COMMIT')
+
+
+def set_filling(conn, filling):
+    # While the queue is filling, running out of pending jobs doesn't mean
+    # there'll be no more
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('filling', ?)", (str(int(filling)),))
+
+
+def is_filling(conn):
+    row = conn.execute("SELECT value FROM meta WHERE key = 'filling'").fetchone()
+    return row is not None and row[0] == '1'
+
+
+def set_gpu_routing(conn, routing):
+    # Whether GPU jobs are kept from hosts without GPUs, which makes sense only
+    # if some of the machines pulling from this queue have GPUs
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('gpu_routing', ?)", (str(int(routing)),))
+
+
+def is_gpu_routing(conn):
+    row = conn.execute("SELECT value FROM meta WHERE key = 'gpu_routing'").fetchone()
+    return row is not None and row[0] == '1'
+
+
+def claim(conn, host, n=1, lease=600, max_gpus=None):
+    # BEGIN IMMEDIATE takes the write lock up front, so no two clients can
+    # select the same pending jobs; a claim expires unless renewed in time.
+    # Higher priority first, then in the order added; hosts with GPUs (see
+    # max_gpus) take GPU jobs before any others, and hosts without only others,
+    # unless no host has any (see set_gpu_routing())
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        if max_gpus is None or (max_gpus <= 0 and not is_gpu_routing(conn)):
+            rows = conn.execute(
+                "SELECT id, cmd, expects FROM jobs WHERE state = 'pending' "
+                "ORDER BY priority DESC, id LIMIT ?", (n,)).fetchall()
+        elif max_gpus > 0:
+            rows = conn.execute(
+                "SELECT id, cmd, expects FROM jobs WHERE state = 'pending' "
+                "ORDER BY gpus > 0 DESC, priority DESC, id LIMIT ?", (n,)).fetchall()
+        else:
+            rows = conn.execute(
+                "SELECT id, cmd, expects FROM jobs WHERE state = 'pending' AND gpus = 0 "
+                "ORDER BY priority DESC, id LIMIT ?", (n,)).fetchall()
+        now = time()
+        conn.executemany(
+            "UPDATE jobs SET state = 'running', host = ?, t_start = ?, lease = ? WHERE id = ?",
+            ((host, now, now + lease, x[0]) for x in rows))
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    return [(x[0], x[1], x[2].split(' ')) for x in rows]
+
+
+def finish(conn, job_id, status):
+    conn.execute(
+        'UPDATE jobs SET state = ?, status = ?, t_end = ? WHERE id = ?',
+        ('done' if status == 0 else 'failed', status, time(), job_id))
+
+
+def release(conn, job_ids):
+    # Return claimed but unfinished jobs to the queue, e.g., on Ctrl-C
+    conn.executemany(
+        "UPDATE jobs SET state = 'pending', host = NULL, t_start = NULL, lease = NULL WHERE id = ?",
+        ((x,) for x in job_ids))
+
+
+def renew(conn, job_ids, lease=600):
+    conn.executemany(
+        "UPDATE jobs SET lease = ? WHERE id = ? AND state = 'running'",
+        ((time() + lease, x) for x in job_ids))
+
+
+def requeue_expired(conn):
+    # Jobs whose claimant stopped renewing, e.g., because its host died
+    return conn.execute(
+        "UPDATE jobs SET state = 'pending', host = NULL, t_start = NULL, lease = NULL "
+        "WHERE state = 'running' AND lease < ?", (time(),)).rowcount
+
+
+def counts(conn):
+    return dict(conn.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+
+
+def peek(conn, n=-1):
+    return [x[0] for x in conn.execute(
+        "SELECT cmd FROM jobs WHERE state = 'pending' ORDER BY priority DESC, id LIMIT ?", (n,))]
+
+
+def requeue_failed(conn, skip=()):
+    conn.execute('BEGIN IMMEDIATE')
+    job_ids = [x[0] for x in conn.execute("SELECT id, cmd FROM jobs WHERE state = 'failed'")
+               if x[1] not in skip]
+    conn.executemany(
+        "UPDATE jobs SET state = 'pending', host = NULL, status = NULL, t_start = NULL, t_end = NULL "
+        "WHERE id = ?", ((x,) for x in job_ids))
+    conn.execute('COMMIT')
+    return len(job_ids)
@@ -1,35 +1,39 @@
-from subprocess import call, check_output, Popen, PIPE
+from socket import gethostname
+from argparse import ArgumentParser
+import logging
+import logging_colorer # noqa: F401 # pylint: disable=unused-import
+import ssh_fanout
+
+logging.basicConfig(level=logging.INFO)
 
 cpu_machines = ['vision%02d' % e for e in range(1, 39)]
 gpu_machines = ['visiongpu%02d' % e for e in range(1, 21)]
 machine_names = cpu_machines + gpu_machines
 
+# Brackets so that pkill doesn't match the shell running this very command
+kill_cmd = 'pkill -9 -u $(whoami) -f "[e]xec_client.py"'
+
 
-def kill(machine_name):
-    if machine_name == check_output('hostname').decode().strip('\n'):
-        # Can't kill this machine
-        return
-    if call('timeout 0.5 ping -c1 %s' % machine_name, shell=True) == 0:
-        is_found = False
-        ps = Popen('ssh -o PasswordAuthentication=no -t %s "ps a -u xiuming x | grep exec_client"' %
-                   machine_name, stdout=PIPE, shell=True).communicate()[0].decode()
-        ps = ps.split('\n')
-        print(ps)
-        for p in ps:
-            if len(p) < 3:
-                continue
-            status = p.split(None, 5)
-            print(status)
-            if status[1] == '?' and 'S' in status[2]:
-                pid = status[0]
-                is_found = True
-                break
-        if is_found:
-            print("found client!")
-            call('ssh -o PasswordAuthentication=no -t %s kill -9 %s' %
-                 (machine_name, pid), shell=True)
+def kill(machine_names, ssh='ssh', ssh_jobs=32, ssh_timeout=10):
+    # Can't kill this machine
+    hostname = gethostname()
+    machine_names = [x for x in machine_names if x != hostname]
+    results = ssh_fanout.fan_out([(x, kill_cmd) for x in machine_names],
+                                 ssh=ssh, max_concurrency=ssh_jobs, timeout=ssh_timeout)
+    # pkill exits with 1 when there was nothing to kill
+    killed = ssh_fanout.summarize(results, "had clients killed", ignore=(1,))
+    idle = [x[0] for x in results if x[1] == 1]
+    logging.info("%d machines had no clients running", len(idle))
+    return killed
 
 
 if __name__ == '__main__':
-    for x in machine_names:
-        kill(x)
+    parser = ArgumentParser(description="Kill exec_client on all machines")
+    parser.add_argument('--ssh', type=str, default='ssh',
+                        help="command to reach machines with")
+    parser.add_argument('--ssh_jobs', type=int, default=32,
+                        help="maximum number of machines to connect to at once")
+    parser.add_argument('--ssh_timeout', type=int, default=10,
+                        help="seconds to wait for each machine before giving up on it")
+    args = parser.parse_args()
+    kill(machine_names, ssh=args.ssh, ssh_jobs=args.ssh_jobs, ssh_timeout=args.ssh_timeout)
@@ -0,0 +1,113 @@
+"""
+Running Commands on Many Machines at Once over ssh
+
+Connections are made concurrently (up to a limit), each with its own timeout,
+and go through one persistent master connection per machine (ControlMaster),
+so that later fan-outs to the same machines, e.g., killing the clients, skip
+the handshake.
+"""
+
+import asyncio
+from os import getuid, lstat, mkdir
+from os.path import join
+from shlex import split
+from tempfile import gettempdir
+import logging
+import stat
+
+
+# Per user, as anyone who can write to the sockets in it can run commands as us
+control_dir = join(gettempdir(), 'dispatch-ssh-%d' % getuid())
+
+
+def make_control_dir():
+    try:
+        mkdir(control_dir, mode=0o700)
+    except FileExistsError:
+        pass
+    # Someone else may have made it first, e.g., as a symlink to a directory of theirs
+    st = lstat(control_dir)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != getuid() or stat.S_IMODE(st.st_mode) != 0o700:
+        raise PermissionError("%s must be a directory owned by this user with mode 700" % control_dir)
+
+
+def ssh_argv(ssh, host, *args, timeout=30):
+    opts = ['-o', 'BatchMode=yes',
+            '-o', 'ConnectTimeout=%d' % timeout,
+            '-o', 'ControlPath=%s' % join(control_dir, '%C')]
+    return split(ssh) + opts + list(args) + [host]
+
+
+async def run_one(ssh, host, remote_cmd, sem, timeout, multiplex):
+    async with sem:
+        try:
+            if multiplex:
+                # Start a master connection unless there's already one alive
+                proc = await asyncio.create_subprocess_exec(
+                    *ssh_argv(ssh, host, '-O', 'check', timeout=timeout),
+                    stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.DEVNULL,
+                    stderr=asyncio.subprocess.DEVNULL)
+                if await asyncio.wait_for(proc.wait(), timeout) != 0:
+                    # Master's stdio is pointed away, or it would keep our pipes open
+                    proc = await asyncio.create_subprocess_exec(
+                        *ssh_argv(ssh, host, '-o', 'ControlMaster=yes', '-o', 'ControlPersist=10m',
+                                  '-f', '-N', timeout=timeout),
+                        stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.DEVNULL,
+                        stderr=asyncio.subprocess.DEVNULL)
+                    await asyncio.wait_for(proc.wait(), timeout)
+            proc = await asyncio.create_subprocess_exec(
+                *(ssh_argv(ssh, host, timeout=timeout) + [remote_cmd]),
+                stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.STDOUT)
+            out, _ = await asyncio.wait_for(proc.communicate(), timeout)
+        except asyncio.TimeoutError:
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            return host, None, "timed out after %d seconds" % timeout
+        return host, proc.returncode, out.decode(errors='replace').strip()
+
+
+async def run_all(host_cmds, ssh, max_concurrency, timeout, multiplex):
+    sem = asyncio.Semaphore(max_concurrency)
+    return await asyncio.gather(*[
+        run_one(ssh, host, remote_cmd, sem, timeout, multiplex) for host, remote_cmd in host_cmds])
+
+
+def fan_out(host_cmds, ssh='ssh', max_concurrency=32, timeout=30, multiplex=True):
+    """
+    Run commands on their machines concurrently
+
+    Args:
+        host_cmds: Machines and what to run on them
+            List of (hostname, command string) pairs
+        ssh: Command to connect with, e.g., 'ssh' or 'python fake_ssh.py' for local testing
+            String
+            Optional; defaults to 'ssh'
+        max_concurrency: Maximum number of connections in flight
+            Integer
+            Optional; defaults to 32
+        timeout: Seconds allowed for connecting and for the command itself, per machine
+            Integer
+            Optional; defaults to 30
+        multiplex: Whether to go through (and leave behind) a master connection per machine
+            Boolean
+            Optional; defaults to True
+
+    Returns:
+        results: Exit status (None if timed out) and output for each machine, in input order
+            List of (hostname, status, output string) triples
+    """
+    if multiplex:
+        make_control_dir()
+    return asyncio.run(run_all(host_cmds, ssh, max_concurrency, timeout, multiplex))
+
+
+def summarize(results, what="accepted", ignore=()):
+    ok = [x[0] for x in results if x[1] == 0]
+    logging.info("%d/%d machines %s: %s", len(ok), len(results), what, ' '.join(ok))
+    for host, status, out in results:
+        if status != 0 and status not in ignore:
+            logging.warning("%s: %s (%s)", host,
+                            "timed out" if status is None else "exit status %d" % status, out)
+    return ok
@@ -5,8 +5,9 @@ Xiuming Zhang, MIT CSAIL
 August 2018
 """
 
-from os import makedirs
-from os.path import abspath, dirname, exists, join, basename
+from os import environ, listdir, makedirs, rename, stat, utime
+from os.path import abspath, exists, expanduser, getmtime, getsize, join, realpath
+from collections.abc import Mapping
 import numpy as np
 import cv2
 
@@ -14,32 +15,215 @@ import config
 logger, thisfile = config.create_logger(abspath(__file__))
 
 
+# Where load_cached() keeps decoded channels by default
+cache_dir = environ.get('XIUMINGLIB_EXR_CACHE', join(expanduser('~'), '.cache', 'xiuminglib', 'exr'))
+
+# OpenEXR's pixel types, UINT, HALF and FLOAT, as NumPy's
+pix_type_dtypes = {0: np.uint32, 1: np.float16, 2: np.float32}
+
+
+class Exr(Mapping):
+    """
+    Lazily loaded .exr, whose header is read right away, but each layer (e.g., all
+        'diffuse_color.*' channels) only when one of its channels is first accessed (then
+        cached), so that using a few of many passes costs only those few
+
+    Each decoding call goes over the whole file, and compressed blocks hold all channels,
+        so channels needed together are better fetched together (see fetch())
+    """
+    def __init__(self, exr_path):
+        """
+        Class constructor
+
+        Args:
+            exr_path: Path to the .exr file
+                String
+        """
+        import OpenEXR
+
+        self.exr_path = exr_path
+        self.f = OpenEXR.InputFile(exr_path)
+        self.header = self.f.header()
+        data_win = self.header['dataWindow']
+        self.shape = (data_win.max.y - data_win.min.y + 1,
+                      data_win.max.x - data_win.min.x + 1)
+        self.y_min = data_win.min.y
+        self.pix_types = {ch: info.type.v for ch, info in self.header['channels'].items()}
+        self.dtypes = {ch: np.dtype(pix_type_dtypes[x]) for ch, x in self.pix_types.items()}
+        self.cache = {}
+
+    def __getitem__(self, ch):
+        if ch not in self.cache:
+            if ch not in self.pix_types:
+                raise KeyError(ch)
+            layer = ch.rpartition('.')[0]
+            self.fetch([x for x in self.pix_types if x.rpartition('.')[0] == layer])
+        return self.cache[ch]
+
+    def __contains__(self, ch):
+        return ch in self.pix_types
+
+    def __iter__(self):
+        return iter(self.pix_types)
+
+    def __len__(self):
+        return len(self.pix_types)
+
+    def fetch(self, chs):
+        """
+        Decode channels not yet cached, those of the same type in one pass over the file
+
+        Args:
+            chs: Channel names
+                List of strings
+        """
+        for ch, arr in self._decode([x for x in chs if x not in self.cache], 0, self.shape[0]):
+            self.cache[ch] = arr
+
+    def fetch_rows(self, chs, first, last):
+        """
+        Decode only some rows of channels, bypassing the cache, so that going over a large file
+            a strip at a time holds no more than a strip of each channel
+
+        Args:
+            chs: Channel names
+                List of strings
+            first: First row, starting from 0 at the top
+                Integer
+            last: Row after the last one
+                Integer
+
+        Returns:
+            strips: '(last - first)'-by-W array of each channel
+                dict of numpy.ndarray
+        """
+        return dict(self._decode(chs, first, last))
+
+    def _decode(self, chs, first, last):
+        import Imath
+
+        chs_by_type = {}
+        for ch in chs:
+            chs_by_type.setdefault(self.pix_types[ch], []).append(ch)
+        for pix_type, chs_ in chs_by_type.items():
+            # Scanlines are numbered within the data window, and the last one is included
+            bufs = self.f.channels(chs_, Imath.PixelType(pix_type), self.y_min + first, self.y_min + last - 1)
+            for i, ch in enumerate(chs_):
+                yield ch, np.frombuffer(bytearray(bufs[i]), dtype=self.dtypes[ch]).reshape(
+                    last - first, self.shape[1])
+                bufs[i] = None # so that there are never two copies of all channels
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
 def load(exr_path):
     """
-    Load .exr as a dict, by converting it to a .npz and loading that .npz
+    Load .exr as a dict of channels, in the pixel types they were stored in
 
     Args:
         exr_path: Path to the .exr file
             String
 
     Returns:
-        data: Loaded OpenEXR data
+        data: Loaded OpenEXR data, with each channel being an H-by-W array of float16, float32
+            or uint32, keyed by channel name (e.g., 'R' or 'diffuse_color.R')
             dict
     """
-    from time import time
-    from subprocess import call
+    import OpenEXR
+
+    if hasattr(OpenEXR, 'File'):
+        # OpenEXR 3.3+ decodes straight into arrays
+        with OpenEXR.File(exr_path, separate_channels=True) as f:
+            return {k: v.pixels for k, v in f.channels().items()}
+
+    with Exr(exr_path) as data:
+        data.fetch(list(data))
+        return dict(data)
+
+
+def load_cached(exr_path, cache_root=None, max_size=10e9):
+    """
+    Same as load(), but with decoded channels kept in a cache as uncompressed .npy files,
+        so that loading the same file again only memory-maps them
+
+    Entries are keyed by the file's real path, size and modification time, so that a file
+        that has changed gets decoded anew; when the cache grows beyond max_size, the least
+        recently used entries are evicted
 
-    # Convert to .npz
-    npz_f = '/tmp/%s_t%s.npz' % \
-        (basename(exr_path).replace('.exr', ''), time())
-    call(['python2',
-          '%s/../../commandline/exr2npz.py' % dirname(abspath(__file__)),
-          exr_path,
-          npz_f])
+    Args:
+        exr_path: Path to the .exr file
+            String
+        cache_root: Cache directory, shared by all processes using it
+            String
+            Optional; defaults to $XIUMINGLIB_EXR_CACHE or ~/.cache/xiuminglib/exr
+        max_size: Size in bytes beyond which entries get evicted
+            Float
+            Optional; defaults to 10e9
 
-    # Load this .npz
-    data = np.load(npz_f)
-    return data
+    Returns:
+        data: Same as load()'s, but with read-only memory-mapped arrays
+            dict
+    """
+    from hashlib import sha1
+    from shutil import rmtree
+    from tempfile import mkdtemp
+    from urllib.parse import quote, unquote
+
+    logger_name = thisfile + '->load_cached()'
+
+    if cache_root is None:
+        cache_root = cache_dir
+    st = stat(exr_path)
+    key = sha1(('%s\n%d\n%d' % (realpath(exr_path), st.st_size, st.st_mtime_ns)).encode()).hexdigest()
+    entry = join(cache_root, key)
+
+    if exists(entry):
+        utime(entry) # now the most recently used
+    else:
+        makedirs(cache_root, exist_ok=True)
+        # Written aside and then moved in place, so that no one sees a half-written entry
+        tmp = mkdtemp(prefix='.', dir=cache_root)
+        for ch, arr in load(exr_path).items():
+            np.save(join(tmp, quote(ch, safe='') + '.npy'), arr)
+        try:
+            rename(tmp, entry)
+        except OSError:
+            # Someone else has just cached the same file
+            rmtree(tmp, ignore_errors=True)
+        else:
+            logger.name = logger_name
+            logger.debug("%s cached at %s", exr_path, entry)
+        _evict_lru(cache_root, max_size, keep=key)
+
+    return {unquote(x[:-len('.npy')]): np.load(join(entry, x), mmap_mode='r') for x in listdir(entry)}
+
+
+def _evict_lru(cache_root, max_size, keep=None):
+    from shutil import rmtree
+
+    entries = []
+    for key in listdir(cache_root):
+        if key.startswith('.'):
+            continue # still being written
+        entry = join(cache_root, key)
+        try:
+            entries.append((getmtime(entry), sum(getsize(join(entry, x)) for x in listdir(entry)), key))
+        except OSError:
+            pass # evicted by someone else meanwhile
+    total = sum(x[1] for x in entries)
+    for _, size, key in sorted(entries):
+        if total <= max_size:
+            break
+        if key != keep:
+            rmtree(join(cache_root, key), ignore_errors=True)
+            total -= size
 
 
 def extract_depth(exr_prefix, outpath, vis=False):
@@ -115,10 +299,11 @@ def extract_normal(exr_path, outpath, vis=False):
 
     # Load RGBA .exr
     # cv2.imread() can't load more than three channels from .exr even with IMREAD_UNCHANGED
-    # Has to go through IO. Maybe there's a better way?
-    data = load(exr_path)
-    arr = np.dstack((data['R'], data['G'], data['B']))
-    alpha = data['A']
+    with Exr(exr_path) as data:
+        data.fetch(['R', 'G', 'B', 'A'])
+        # Saved as float32, as always, even if stored as half floats
+        arr = np.dstack((data['R'], data['G'], data['B'])).astype(np.float32, copy=False)
+        alpha = data['A'].astype(np.float32)
 
     if not outpath.endswith('.npy'):
         outpath += '.npy'
@@ -137,6 +322,63 @@ def extract_normal(exr_path, outpath, vis=False):
     logger.info("Normal image extractd at %s", outpath)
 
 
+# What's extracted from lighting passes, in this order
+intrinsic_names = ['albedo', 'shading', 'specularity', 'recon', 'composite']
+
+
+def intrinsic_images_from_lighting_passes(exr_path, rows_per_strip=64):
+    """
+    Compute intrinsic images from a multi-layer .exr of lighting passes
+
+    Args:
+        exr_path: Path to the multi-layer .exr file
+            String
+        rows_per_strip: Rows of the passes decoded at a time, best a multiple of the 16 or 32 rows
+            that ZIP or PIZ compresses together, or those blocks get decoded more than once
+            Integer
+            Optional; defaults to 64
+
+    Returns:
+        images: H-by-W-by-4 RGBA image of each of intrinsic_names
+            dict of numpy.ndarray
+    """
+    groups = {'albedo': ['diffuse_color', 'glossy_color'],
+              'shading': ['diffuse_indirect', 'diffuse_direct'],
+              'specularity': ['glossy_indirect', 'glossy_direct'],
+              # Composite from Blender, just for sanity check
+              'composite': ['composite']}
+
+    with Exr(exr_path) as data:
+        images = {k: np.empty(data.shape + (4,), dtype=np.float32) for k in groups}
+        # Only the passes used here get decoded, a strip of rows at a time, so that what's held
+        # besides the outputs is a strip of each pass, while each part of the file is still
+        # decoded just once
+        chs = [comp + '.' + ch for comps in groups.values() for comp in comps for ch in ['R', 'G', 'B', 'A']]
+        for first in range(0, data.shape[0], rows_per_strip):
+            last = min(first + rows_per_strip, data.shape[0])
+            strips = data.fetch_rows(chs, first, last)
+            for name, components in groups.items():
+                # Summed straight into the output
+                out = images[name][first:last]
+                for i, ch in enumerate(['R', 'G', 'B']):
+                    out[:, :, i] = strips[components[0] + '.' + ch]
+                    for comp in components[1:]:
+                        out[:, :, i] += strips[comp + '.' + ch]
+                # Alpha channels can't be added up, but must all be the same
+                out[:, :, 3] = strips[components[0] + '.A']
+                for comp in components[1:]:
+                    assert np.array_equal(out[:, :, 3], strips[comp + '.A']), \
+                        "Alpha channels of all passes must be the same"
+
+    # Reconstruction vs. composite
+    recon = np.multiply(images['albedo'], images['shading'])
+    recon += images['specularity']
+    recon[:, :, 3] = images['albedo'][:, :, 3] # can't add up alpha channels
+    images['recon'] = recon
+
+    return images
+
+
 def extract_intrinsic_images_from_lighting_passes(exr_path, outdir, vis=False):
     """
     Extract intrinsic images from a multi-layer .exr of lighting passes
@@ -158,54 +400,124 @@ def extract_intrinsic_images_from_lighting_passes(exr_path, outdir, vis=False):
     if not exists(outdir):
         makedirs(outdir)
 
-    data = load(exr_path)
-
-    def collapse_passes(components):
-        ch_arrays = []
-        for ch in ['R', 'G', 'B']:
-            comp_arrs = []
-            for comp in components:
-                comp_arrs.append(data[comp + '.' + ch])
-            ch_array = np.sum(comp_arrs, axis=0) # sum components
-            ch_arrays.append(ch_array)
-        # Handle alpha channel
-        first_alpha = data[components[0] + '.A']
-        for ci in range(1, len(components)):
-            assert (first_alpha == data[components[ci] + '.A']).all(), \
-                "Alpha channels of all passes must be the same"
-        ch_arrays.append(first_alpha)
-        return np.dstack(ch_arrays)
-
-    # Albedo
-    albedo = collapse_passes(['diffuse_color', 'glossy_color'])
-    np.save(join(outdir, 'albedo.npy'), albedo)
-    if vis:
-        xv.matrix_as_image(albedo, outpath=join(outdir, 'albedo.png'))
+    images = intrinsic_images_from_lighting_passes(exr_path)
+    for name in intrinsic_names:
+        np.save(join(outdir, name + '.npy'), images[name])
+        if vis:
+            xv.matrix_as_image(images[name], outpath=join(outdir, name + '.png'))
 
-    # Shading
-    shading = collapse_passes(['diffuse_indirect', 'diffuse_direct'])
-    np.save(join(outdir, 'shading.npy'), shading)
-    if vis:
-        xv.matrix_as_image(shading, join(outdir, 'shading.png'))
+    logger.name = logger_name
+    logger.info("Intrinsic images extracted to %s", outdir)
 
-    # Specularity
-    specularity = collapse_passes(['glossy_indirect', 'glossy_direct'])
-    np.save(join(outdir, 'specularity.npy'), specularity)
-    if vis:
-        xv.matrix_as_image(specularity, join(outdir, 'specularity.png'))
 
-    # Reconstruction vs.
-    recon = np.multiply(albedo, shading) + specularity
-    recon[:, :, 3] = albedo[:, :, 3] # can't add up alpha channels
-    np.save(join(outdir, 'recon.npy'), recon)
-    if vis:
-        xv.matrix_as_image(recon, join(outdir, 'recon.png'))
+def open_intrinsic_store(store_path, n_frames, shape, dtype='float16', tile=64):
+    """
+    Open (creating if needed) an HDF5 file holding the intrinsic images of a whole sequence,
+        each as an N-by-H-by-W-by-4 dataset compressed in chunks of one frame's tile, so that
+        a region across frames is read without decompressing whole frames
 
-    # ... composite from Blender, just for sanity check
-    composite = collapse_passes(['composite'])
-    np.save(join(outdir, 'composite.npy'), composite)
-    if vis:
-        xv.matrix_as_image(composite, join(outdir, 'composite.png'))
+    Args:
+        store_path: Path to the .h5 file
+            String
+        n_frames: Number of frames in the sequence
+            Integer
+        shape: Height and width of each frame
+            Tuple of integers
+        dtype: Data type stored; 'float16' halves the size but caps values at 65504
+            String
+            Optional; defaults to 'float16'
+        tile: Side length of a chunk in pixels
+            Integer
+            Optional; defaults to 64
+
+    Returns:
+        store: Opened file, where 'done' marks frames already written
+            h5py.File
+    """
+    import h5py
+
+    store = h5py.File(store_path, 'a')
+    chunks = (1, min(tile, shape[0]), min(tile, shape[1]), 4)
+    for name in intrinsic_names:
+        if name in store:
+            assert store[name].shape == (n_frames,) + tuple(shape) + (4,), \
+                "%s in %s was made for a different sequence" % (name, store_path)
+        else:
+            store.create_dataset(name, shape=(n_frames,) + tuple(shape) + (4,), dtype=dtype,
+                                 chunks=chunks, compression='gzip', compression_opts=1, shuffle=True)
+    if 'done' not in store:
+        store.create_dataset('done', shape=(n_frames,), dtype=bool)
+    return store
+
+
+def write_intrinsic_frame(store, i, images):
+    """
+    Write intrinsic images of a frame into a store from open_intrinsic_store()
+
+    Args:
+        store: Opened store
+            h5py.File
+        i: Frame index
+            Integer
+        images: Images from intrinsic_images_from_lighting_passes()
+            dict of numpy.ndarray
+    """
+    for name in intrinsic_names:
+        store[name][i] = images[name]
+    # Last, so that a frame interrupted halfway gets redone
+    store['done'][i] = True
+
+
+def extract_intrinsic_images_to_store(exr_paths, store_path, dtype='float16', tile=64):
+    """
+    Extract intrinsic images from a sequence of multi-layer .exr files of lighting passes
+        into one chunked, compressed store, skipping frames already there
+
+    Args:
+        exr_paths: Paths to the multi-layer .exr files, one per frame
+            List of strings
+        store_path: Path to the .h5 file
+            String
+        dtype: Data type stored
+            String
+            Optional; defaults to 'float16'
+        tile: Side length of a chunk in pixels
+            Integer
+            Optional; defaults to 64
+    """
+    logger_name = thisfile + '->extract_intrinsic_images_to_store()'
+
+    with Exr(exr_paths[0]) as data:
+        shape = data.shape
+    with open_intrinsic_store(store_path, len(exr_paths), shape, dtype=dtype, tile=tile) as store:
+        done = store['done'][:]
+        for i, exr_path in enumerate(exr_paths):
+            if not done[i]:
+                write_intrinsic_frame(store, i, intrinsic_images_from_lighting_passes(exr_path))
 
     logger.name = logger_name
-    logger.info("Intrinsic images extracted to %s", outdir)
+    logger.info("Intrinsic images of %d frames extracted to %s", len(exr_paths), store_path)
+
+
+def load_intrinsic_images(store_path, name, frames=slice(None), rows=slice(None), cols=slice(None)):
+    """
+    Read a region of one intrinsic image across frames from a store, decompressing only
+        the chunks it overlaps
+
+    Args:
+        store_path: Path to the .h5 file
+            String
+        name: Which image, out of intrinsic_names
+            String
+        frames, rows, cols: Frames, rows and columns to read
+            Slices
+            Optional; default to all
+
+    Returns:
+        arr: Frames-by-rows-by-columns-by-4 array, in the stored data type
+            numpy.ndarray
+    """
+    import h5py
+
+    with h5py.File(store_path, 'r') as store:
+        return store[name][frames, rows, cols]
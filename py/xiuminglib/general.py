@@ -13,6 +13,33 @@ import config
 logger, thisfile = config.create_logger(abspath(__file__))
 
 
+def iter_batch(argv=None):
+    """
+    Iterate over the params lines a job script is given, so that scripts dispatched
+        in batches (dispatch.py --batch) pay for their startup once per batch
+
+    Args:
+        argv: Command-line arguments, without the program name
+            List of strings
+            Optional; defaults to None (sys.argv[1:])
+
+    Yields:
+        args: Arguments from one params line, split as a shell would
+            List of strings; just 'argv' if the script wasn't given a batch
+    """
+    from shlex import split
+
+    if argv is None:
+        argv = sys.argv[1:]
+
+    if len(argv) == 2 and argv[0] == '--dispatch_batch':
+        with open(argv[1]) as f:
+            for l in f:
+                yield split(l)
+    else:
+        yield argv
+
+
 def print_attrs(obj, excerpts=None, excerpt_win_size=60, max_recursion_depth=None):
     """
     Print all attributes, recursively, of an object
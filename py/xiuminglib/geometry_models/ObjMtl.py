@@ -8,6 +8,7 @@ June 2017
 from os import makedirs
 from os.path import abspath, basename, dirname, exists, join
 from shutil import copy
+from itertools import chain
 import numpy as np
 
 import config
@@ -28,7 +29,8 @@ class Obj(object):
                 *-by-3 numpy array of floats
                 Optional; defaults to None
             f: Faces' vertex indices
-                List of lists of integers starting from 1, e.g., '[[1, 2, 3], [4, 5, 6], [7, 8, 9, 10], ...]'
+                List of lists of integers starting from 1, e.g., '[[1, 2, 3], [4, 5, 6], [7, 8, 9, 10], ...]',
+                    or *-by-k numpy array of integers if all faces have k vertices
                 Optional; defaults to None
             vn: Vertex normals
                 *-by-3 numpy array of floats, normalized or unnormalized
@@ -72,21 +74,85 @@ class Obj(object):
         self.vt = vt
         self.vn = vn
 
-        # Faces
-        if f is not None:
-            if ft is not None:
-                assert (len(ft) == len(f)), "'ft' must be of the same length as 'f' (use '[]' to fill)"
-            if fn is not None:
-                assert (len(fn) == len(f)), "'fn' must be of the same length as 'f' (use '[]' to fill)"
+        # Faces, stored CSR-style: the indices of face i are 'f_indices[f_indptr[i]:f_indptr[i + 1]]',
+        # and likewise for 'ft' and 'fn', where an empty range stands for '[]'
         self.f = f
         self.ft = ft
         self.fn = fn
+        if f is not None:
+            if ft is not None:
+                assert (len(self.ft_indptr) == len(self.f_indptr)), \
+                    "'ft' must be of the same length as 'f' (use '[]' to fill)"
+            if fn is not None:
+                assert (len(self.fn_indptr) == len(self.f_indptr)), \
+                    "'fn' must be of the same length as 'f' (use '[]' to fill)"
 
         self.usemtl = usemtl
         self.s = s
         self.diffuse_map_path = diffuse_map_path
         self.diffuse_map_scale = diffuse_map_scale
 
+    # Faces as lists of lists, as they used to be stored; see face_lists()
+    @property
+    def f(self):
+        """
+        Faces' vertex indices, as a copy built from 'f_indices' and 'f_indptr' on each read,
+            so changes to it must be assigned back
+        """
+        return self.face_lists('f')
+
+    @f.setter
+    def f(self, f):
+        self.f_indices, self.f_indptr = _to_csr(f)
+
+    @property
+    def ft(self):
+        """
+        Faces' texture vertex indices, as a copy built on each read, like 'f'
+        """
+        return self.face_lists('ft')
+
+    @ft.setter
+    def ft(self, ft):
+        self.ft_indices, self.ft_indptr = _to_csr(ft)
+
+    @property
+    def fn(self):
+        """
+        Faces' vertex normal indices, as a copy built on each read, like 'f'
+        """
+        return self.face_lists('fn')
+
+    @fn.setter
+    def fn(self, fn):
+        self.fn_indices, self.fn_indptr = _to_csr(fn)
+
+    def face_lists(self, which='f'):
+        """
+        Faces as lists, built anew from the arrays on each call; changes to them must be assigned back
+
+        Args:
+            which: What faces
+                'f', 'ft' or 'fn'
+                Optional; defaults to 'f'
+
+        Returns:
+            faces: Indices of each face, with '[]' for faces without 'ft' or 'fn', or None if there are none
+                List of lists of integers starting from 1
+        """
+        assert which in ('f', 'ft', 'fn'), "'which' must be 'f', 'ft' or 'fn'"
+        return _csr_to_lists(getattr(self, which + '_indices'), getattr(self, which + '_indptr'))
+
+    @property
+    def triangles(self):
+        """
+        Faces' vertex indices as an n-by-3 array (a view of 'f_indices') if all faces are triangles;
+            None otherwise
+        """
+        if self.f_indices is None or not (np.diff(self.f_indptr) == 3).all():
+            return None
+        return self.f_indices.reshape(-1, 3)
+
     # Populate attributes with contents read from file
     def load_file(self, obj_file):
         """
@@ -99,98 +165,31 @@ class Obj(object):
         Returns:
             self: updated object
         """
-        fid = open(obj_file, 'r')
-        lines = [l.strip('\n') for l in fid.readlines()]
-        lines = [l for l in lines if len(l) > 0] # remove empty lines
-
-        # Check if there's only one object
-        n_o = len([l for l in lines if l[0] == 'o'])
-        if n_o > 1:
-            raise ValueError(".obj file containing multiple objects is not supported -- consider using 'assimp' instead")
-
-        # Count for array initializations
-        n_v = len([l for l in lines if l[:2] == 'v '])
-        n_vt = len([l for l in lines if l[:3] == 'vt '])
-        n_vn = len([l for l in lines if l[:3] == 'vn '])
-        lines_f = [l for l in lines if l[:2] == 'f ']
-        n_f = len(lines_f)
-
-        # Initialize arrays
-        mtllib = None
-        o = None
-        v = np.zeros((n_v, 3))
-        vt = np.zeros((n_vt, 2))
-        vn = np.zeros((n_vn, 3))
-        usemtl = None
-        s = False
-        f = [None] * n_f
-        # If there's no 'ft' or 'fn' for a 'f', a '[]' is inserted as a placeholder
-        # This guarantees 'f[i]' always corresponds to 'ft[i]' and 'fn[i]'
-        ft = [None] * n_f
-        fn = [None] * n_f
-
-        # Load data line by line
-        n_ft, n_fn = 0, 0
-        i_v, i_vt, i_vn, i_f = 0, 0, 0, 0
-        for l in lines:
-            if l[0] == '#': # comment
-                pass
-            elif l[:7] == 'mtllib ': # mtl file
-                mtllib = l[7:]
-            elif l[:2] == 'o ': # object name
-                o = l[2:]
-            elif l[:2] == 'v ': # geometric vertex
-                v[i_v, :] = [float(x) for x in l[2:].split(' ')]
-                i_v += 1
-            elif l[:3] == 'vt ': # texture vertex
-                vt[i_vt, :] = [float(x) for x in l[3:].split(' ')]
-                i_vt += 1
-            elif l[:3] == 'vn ': # normal vector
-                vn[i_vn, :] = [float(x) for x in l[3:].split(' ')]
-                i_vn += 1
-            elif l[:7] == 'usemtl ': # material name
-                usemtl = l[7:]
-            elif l[:2] == 's ': # group smoothing
-                if l[2:] == 'on':
-                    s = True
-            elif l[:2] == 'f ': # face
-                n_slashes = l[2:].split(' ')[0].count('/')
-                if n_slashes == 0: # just f (1 2 3)
-                    f[i_f] = [int(x) for x in l[2:].split(' ')]
-                    ft[i_f] = []
-                    fn[i_f] = []
-                elif n_slashes == 1: # f and ft (1/1 2/2 3/3)
-                    f[i_f] = [int(x.split('/')[0]) for x in l[2:].split(' ')]
-                    ft[i_f] = [int(x.split('/')[1]) for x in l[2:].split(' ')]
-                    fn[i_f] = []
-                    n_ft += 1
-                elif n_slashes == 2:
-                    if l[2:].split(' ')[0].count('//') == 1: # f and fn (1//1 2//1 3//1)
-                        f[i_f] = [int(x.split('//')[0]) for x in l[2:].split(' ')]
-                        ft[i_f] = []
-                        fn[i_f] = [int(x.split('//')[1]) for x in l[2:].split(' ')]
-                        n_fn += 1
-                    else: # f, ft and fn (1/1/1 2/2/1 3/3/1)
-                        f[i_f] = [int(x.split('/')[0]) for x in l[2:].split(' ')]
-                        ft[i_f] = [int(x.split('/')[1]) for x in l[2:].split(' ')]
-                        fn[i_f] = [int(x.split('/')[2]) for x in l[2:].split(' ')]
-                        n_ft += 1
-                        n_fn += 1
-                i_f += 1
-            else:
-                raise ValueError("Unidentified line type: %s" % l)
+        parsed = _parse_obj(obj_file)
 
         # Update self
-        self.mtllib = mtllib
-        self.o = o
-        self.v = v
-        self.vt = vt if vt.shape[0] > 0 else None
-        self.vn = vn if vn.shape[0] > 0 else None
-        self.f = f
-        self.ft = ft if any(ft) else None # any member list not empty
-        self.fn = fn if any(fn) else None
-        self.usemtl = usemtl
-        self.s = s
+        self.mtllib = parsed['mtllib']
+        self.o = parsed['o']
+        self.v = parsed['v']
+        self.vt = parsed['vt'] if parsed['vt'].shape[0] > 0 else None
+        self.vn = parsed['vn'] if parsed['vn'].shape[0] > 0 else None
+        n_verts = parsed['n_verts']
+        self.f_indices = parsed['f'].astype(np.int32)
+        self.f_indptr = _indptr(n_verts)
+        # If there's no 'ft' or 'fn' for a 'f', an empty range ('[]' in the list view) is its placeholder
+        # This guarantees 'f[i]' always corresponds to 'ft[i]' and 'fn[i]'
+        if parsed['has_ft'].any():
+            self.ft_indices = parsed['ft'].astype(np.int32)
+            self.ft_indptr = _indptr(n_verts * parsed['has_ft'])
+        else:
+            self.ft_indices, self.ft_indptr = None, None
+        if parsed['has_fn'].any():
+            self.fn_indices = parsed['fn'].astype(np.int32)
+            self.fn_indptr = _indptr(n_verts * parsed['has_fn'])
+        else:
+            self.fn_indices, self.fn_indptr = None, None
+        self.usemtl = parsed['usemtl']
+        self.s = parsed['s']
 
     # Print model info
     def print_info(self):
@@ -206,13 +205,13 @@ class Obj(object):
         s = self.s
         diffuse_map_path = self.diffuse_map_path
         diffuse_map_scale = self.diffuse_map_scale
-        n_f = len(self.f) if self.f is not None else 0
-        if self.ft is not None:
-            n_ft = sum(len(x) > 0 for x in self.ft) # pylint: disable=len-as-condition
+        n_f = len(self.f_indptr) - 1 if self.f_indices is not None else 0
+        if self.ft_indices is not None:
+            n_ft = np.count_nonzero(np.diff(self.ft_indptr))
         else:
             n_ft = 0
-        if self.fn is not None:
-            n_fn = sum(len(x) > 0 for x in self.fn) # pylint: disable=len-as-condition
+        if self.fn_indices is not None:
+            n_fn = np.count_nonzero(np.diff(self.fn_indptr))
         else:
             n_fn = 0
 
@@ -234,9 +233,8 @@ class Obj(object):
         if n_f > 0:
             logger.info("")
             logger.info("Among %d faces:", n_f)
-            vert_counts = [len(x) for x in self.f]
-            for c in np.unique(vert_counts):
-                howmany = vert_counts.count(c)
+            vert_counts, howmanys = np.unique(np.diff(self.f_indptr), return_counts=True)
+            for c, howmany in zip(vert_counts, howmanys):
                 logger.info("  - %d are formed by %d vertices", howmany, c)
         logger.info("-------------------------------------------------------")
 
@@ -254,28 +252,23 @@ class Obj(object):
         """
         logger.name = thisfile + '->Obj:set_face_normals()'
 
-        n_f = len(self.f)
-        vn = np.zeros((n_f, 3))
-        fn = [None] * n_f
-
-        # For each face
-        for i, verts_id in enumerate(self.f):
-            # Vertices must be coplanar to be valid, so we can just pick the first three
-            ind = [x - 1 for x in verts_id[:3]] # in .obj, index starts from 1, not 0
-            verts = self.v[ind, :]
-            p1p2 = verts[1, :] - verts[0, :]
-            p1p3 = verts[2, :] - verts[0, :]
-            normal = np.cross(p1p2, p1p3)
-            if np.linalg.norm(normal) == 0:
-                raise ValueError("Normal vector of zero length probably due to numerical issues?")
-            vn[i, :] = normal / np.linalg.norm(normal) # normalize
-            fn[i] = [i + 1] * len(verts_id)
+        n_f = len(self.f_indptr) - 1
+
+        # Vertices must be coplanar to be valid, so we can just pick the first three of each face
+        p1, p2, p3 = [self.v[self.f_indices[self.f_indptr[:-1] + k] - 1, :] # in .obj, index starts from 1, not 0
+                      for k in range(3)]
+        normals = np.cross(p2 - p1, p3 - p1)
+        norms = np.linalg.norm(normals, axis=1)
+        if (norms == 0).any():
+            raise ValueError("Normal vector of zero length probably due to numerical issues?")
+        vn = normals / norms[:, None] # normalize
 
         # Set normals and return
         self.vn = vn
-        self.fn = fn
+        self.fn_indices = np.repeat(np.arange(1, n_f + 1, dtype=np.int32), np.diff(self.f_indptr))
+        self.fn_indptr = self.f_indptr.copy()
         logger.info("Face normals recalculated with 'v' and 'f' -- 'vn' and 'fn' updated")
-        return vn, fn
+        return vn, self.face_lists('fn')
 
     # Output object to file
     def write_file(self, objpath):
@@ -289,7 +282,6 @@ class Obj(object):
         v, vt, vn = self.v, self.vt, self.vn
         usemtl = self.usemtl
         s = self.s
-        f, ft, fn = self.f, self.ft, self.fn
 
         # mkdir if necessary
         outdir = dirname(objpath)
@@ -306,14 +298,11 @@ class Obj(object):
             fid.write('o %s\n' % o)
 
             # Vertices
-            for i in range(v.shape[0]):
-                fid.write('v %f %f %f\n' % tuple(v[i, :]))
+            _write_rows(fid, 'v %f %f %f\n', v)
             if vt is not None:
-                for i in range(vt.shape[0]):
-                    fid.write('vt %f %f\n' % tuple(vt[i, :]))
+                _write_rows(fid, 'vt %f %f\n', vt)
             if vn is not None:
-                for i in range(vn.shape[0]):
-                    fid.write('vn %f %f %f\n' % tuple(vn[i, :]))
+                _write_rows(fid, 'vn %f %f %f\n', vn)
 
             # Material name
             if usemtl is not None:
@@ -326,50 +315,215 @@ class Obj(object):
                 fid.write('s off\n')
 
             # Faces
-            if ft is None and fn is None: # just f (1 2 3)
-                for v_id in f:
-                    fid.write(('f' + ' %d' * len(v_id) + '\n') % tuple(v_id))
-            elif ft is not None and fn is None: # f and ft (1/1 2/2 3/3 or 1 2 3)
-                for i, v_id in enumerate(f):
-                    vt_id = ft[i]
-                    if len(vt_id) == len(v_id):
-                        fid.write(('f' + ' %d/%d' * len(v_id) + '\n') %
-                                  tuple([x for pair in zip(v_id, vt_id) for x in pair]))
-                    elif not vt_id:
-                        fid.write(('f' + ' %d' * len(v_id) + '\n') % tuple(v_id))
-                    else:
-                        raise ValueError("'ft[%d]', not empty, doesn't match length of 'f[%d]'" % (i, i))
-            elif ft is None and fn is not None: # f and fn (1//1 2//1 3//1 or 1 2 3)
-                for i, v_id in enumerate(f):
-                    vn_id = fn[i]
-                    if len(vn_id) == len(v_id):
-                        fid.write(('f' + ' %d//%d' * len(v_id) + '\n') %
-                                  tuple([x for pair in zip(v_id, vn_id) for x in pair]))
-                    elif not vn_id:
-                        fid.write(('f' + ' %d' * len(v_id) + '\n') % tuple(v_id))
-                    else:
-                        raise ValueError("'fn[%d]', not empty, doesn't match length of 'f[%d]'" % (i, i))
-            elif ft is not None and fn is not None: # f, ft and fn (1/1/1 2/2/1 3/3/1 or 1/1 2/2 3/3 or 1//1 2//1 3//1 or 1 2 3)
-                for i, v_id in enumerate(f):
-                    vt_id = ft[i]
-                    vn_id = fn[i]
-                    if len(vt_id) == len(v_id) and len(vn_id) == len(v_id):
-                        fid.write(('f' + ' %d/%d/%d' * len(v_id) + '\n') %
-                                  tuple([x for triple in zip(v_id, vt_id, vn_id) for x in triple]))
-                    elif len(vt_id) == len(v_id) and not vn_id:
-                        fid.write(('f' + ' %d/%d' * len(v_id) + '\n') %
-                                  tuple([x for pair in zip(v_id, vt_id) for x in pair]))
-                    elif not vt_id and len(vn_id) == len(v_id):
-                        fid.write(('f' + ' %d//%d' * len(v_id) + '\n') %
-                                  tuple([x for pair in zip(v_id, vn_id) for x in pair]))
-                    elif not vt_id and not vn_id:
-                        fid.write(('f' + ' %d' * len(v_id) + '\n') % tuple(v_id))
-                    else:
-                        raise ValueError(
-                            "If not empty, 'ft[%d]' or 'fn[%d]' doesn't match length of 'f[%d]'" % (i, i, i))
+            n_verts = np.diff(self.f_indptr)
+            has_ft = np.zeros(n_verts.shape, dtype=bool)
+            has_fn = np.zeros(n_verts.shape, dtype=bool)
+            if self.ft_indices is not None:
+                n_ft_verts = np.diff(self.ft_indptr)
+                has_ft = n_ft_verts > 0
+                mismatched = np.flatnonzero(has_ft & (n_ft_verts != n_verts))
+                if mismatched.size > 0:
+                    raise ValueError("'ft[%d]', not empty, doesn't match length of 'f[%d]'" %
+                                     (mismatched[0], mismatched[0]))
+            if self.fn_indices is not None:
+                n_fn_verts = np.diff(self.fn_indptr)
+                has_fn = n_fn_verts > 0
+                mismatched = np.flatnonzero(has_fn & (n_fn_verts != n_verts))
+                if mismatched.size > 0:
+                    raise ValueError("'fn[%d]', not empty, doesn't match length of 'f[%d]'" %
+                                     (mismatched[0], mismatched[0]))
+            # Runs of consecutive faces with the same number of vertices and format are written together:
+            # 1 2 3, 1/1 2/2 3/3, 1//1 2//1 3//1 or 1/1/1 2/2/1 3/3/1
+            kinds = 4 * n_verts + 2 * has_ft + has_fn
+            run_starts = np.flatnonzero(np.diff(kinds, prepend=-1))
+            run_ends = np.append(run_starts[1:], kinds.size)
+            for i, j in zip(run_starts.tolist(), run_ends.tolist()):
+                cols = [self.f_indices[self.f_indptr[i]:self.f_indptr[j]]]
+                if has_ft[i]:
+                    cols.append(self.ft_indices[self.ft_indptr[i]:self.ft_indptr[j]])
+                if has_fn[i]:
+                    cols.append(self.fn_indices[self.fn_indptr[i]:self.fn_indptr[j]])
+                vert_fmt = {(False, False): ' %d', (True, False): ' %d/%d',
+                            (False, True): ' %d//%d', (True, True): ' %d/%d/%d'}[(has_ft[i], has_fn[i])]
+                _write_rows(fid, 'f' + vert_fmt * n_verts[i] + '\n', np.stack(cols, axis=-1).reshape(j - i, -1))
         logger.info("Done writing to %s", objpath)
 
 
+# Lines of these types are parsed in bulk, all others one by one
+_V, _VT, _VN, _F, _OTHER = range(5)
+
+
+def _parse_obj(obj_file):
+    """
+    Parse a .obj file with lines of the same type, in runs of consecutive lines, tokenized by
+        NumPy in one go, instead of line by line
+
+    Returns:
+        parsed: 'v', 'vt' and 'vn' as arrays; 'f', 'ft' and 'fn' as flat arrays of indices of
+            all faces' vertices, where only faces with 'has_ft' or 'has_fn' have 'ft' or 'fn';
+            'n_verts' of each face; and 'o', 'mtllib', 'usemtl' and 's'
+            dict
+    """
+    import mmap
+
+    with open(obj_file, 'rb') as fid:
+        try:
+            buf = mmap.mmap(fid.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError: # empty file
+            buf = b''
+    b = np.frombuffer(buf, dtype=np.uint8)
+
+    # Lines, without empty ones
+    ends = np.flatnonzero(b == ord('\n'))
+    if b.size > 0 and b[-1] != ord('\n'):
+        ends = np.append(ends, b.size)
+    starts = np.concatenate(([0], ends + 1))[:ends.size]
+    nonempty = ends > starts
+    starts, ends = starts[nonempty], ends[nonempty]
+
+    # Line types, by their first two characters
+    c0 = b[starts]
+    c1 = np.where(ends - starts > 1, b[np.minimum(starts + 1, b.size - 1)], 0)
+    kinds = np.full(starts.shape, _OTHER, dtype=np.int8)
+    kinds[(c0 == ord('v')) & (c1 == ord(' '))] = _V
+    kinds[(c0 == ord('v')) & (c1 == ord('t'))] = _VT
+    kinds[(c0 == ord('v')) & (c1 == ord('n'))] = _VN
+    kinds[(c0 == ord('f')) & (c1 == ord(' '))] = _F
+
+    parsed = {'mtllib': None, 'o': None, 'usemtl': None, 's': False}
+    chunks = {x: [] for x in ['v', 'vt', 'vn', 'f', 'ft', 'fn', 'n_verts', 'has_ft', 'has_fn']}
+    n_o = 0
+    run_starts = np.flatnonzero(np.diff(kinds, prepend=-1))
+    run_ends = np.append(run_starts[1:], kinds.size)
+    for i, j in zip(run_starts, run_ends):
+        kind = kinds[i]
+        if kind == _OTHER:
+            for k in range(i, j):
+                l = bytes(buf[starts[k]:ends[k]]).decode().rstrip('\r')
+                if l[0] == '#': # comment
+                    pass
+                elif l[:7] == 'mtllib ': # mtl file
+                    parsed['mtllib'] = l[7:]
+                elif l[:2] == 'o ': # object name
+                    parsed['o'] = l[2:]
+                    n_o += 1
+                elif l[:7] == 'usemtl ': # material name
+                    parsed['usemtl'] = l[7:]
+                elif l[:2] == 's ': # group smoothing
+                    if l[2:] == 'on':
+                        parsed['s'] = True
+                else:
+                    raise ValueError("Unidentified line type: %s" % l)
+        elif kind == _F:
+            chunks_f = _parse_faces(b[starts[i]:ends[j - 1]], starts[i:j] - starts[i])
+            for k, x in zip(['f', 'ft', 'fn', 'n_verts', 'has_ft', 'has_fn'], chunks_f):
+                chunks[k].append(x)
+        else:
+            # Geometric vertices, texture vertices or normal vectors
+            name, n_dims = {_V: ('v', 3), _VT: ('vt', 2), _VN: ('vn', 3)}[kind]
+            seg = b[starts[i]:ends[j - 1]]
+            # Lines of the wrong length would otherwise just shift the numbers into other rows
+            n_numbers = _count_tokens(seg, starts[i:j] - starts[i]) - 1 # minus the 'v', 'vt' or 'vn'
+            wrong = np.flatnonzero(n_numbers != n_dims)
+            if wrong.size > 0:
+                k = i + wrong[0]
+                raise ValueError("'%s' lines must each have %d numbers: %s" %
+                                 (name, n_dims, bytes(buf[starts[k]:ends[k]]).decode().rstrip('\r')))
+            arr = np.fromstring(bytes(seg).replace(name.encode(), b' '), sep=' ')
+            if arr.size != (j - i) * n_dims:
+                raise ValueError("'%s' lines (%d-%d) must each have %d numbers" % (name, i + 1, j, n_dims))
+            chunks[name].append(arr.reshape(-1, n_dims))
+
+    # Check if there's only one object
+    if n_o > 1:
+        raise ValueError(".obj file containing multiple objects is not supported -- consider using 'assimp' instead")
+
+    for name, n_dims in [('v', 3), ('vt', 2), ('vn', 3)]:
+        parsed[name] = np.concatenate(chunks[name]) if chunks[name] else np.zeros((0, n_dims))
+    for name, dtype in [('f', int), ('ft', int), ('fn', int), ('n_verts', int), ('has_ft', bool), ('has_fn', bool)]:
+        parsed[name] = np.concatenate(chunks[name]) if chunks[name] else np.zeros((0,), dtype=dtype)
+    return parsed
+
+
+def _count_tokens(seg, line_starts):
+    # Whitespace-separated tokens on each of the consecutive lines in 'seg', starting at 'line_starts'
+    is_space = (seg == ord(' ')) | (seg == ord('\t')) | (seg == ord('\n')) | (seg == ord('\r'))
+    token_starts = ~is_space
+    token_starts[1:] &= is_space[:-1]
+    return np.add.reduceat(token_starts, line_starts, dtype=int)
+
+
+def _parse_faces(seg, line_starts):
+    # 'seg' holds consecutive 'f' lines as bytes, starting at 'line_starts'
+    is_slash = seg == ord('/')
+    double_slashes = np.zeros_like(is_slash)
+    double_slashes[:-1] = is_slash[:-1] & is_slash[1:]
+    n_verts = _count_tokens(seg, line_starts) - 1 # minus the 'f'
+    n_slashes = np.add.reduceat(is_slash, line_starts, dtype=int)
+    n_double_slashes = np.add.reduceat(double_slashes, line_starts, dtype=int)
+
+    # Each line has its own format: 1 2 3, 1/1 2/2 3/3, 1//1 2//1 3//1 or 1/1/1 2/2/1 3/3/1
+    has_ft = (n_slashes == n_verts) | ((n_slashes == 2 * n_verts) & (n_double_slashes == 0))
+    has_fn = n_slashes == 2 * n_verts
+    if not (has_ft | has_fn | (n_slashes == 0)).all():
+        raise ValueError("Unidentified face format in %s" % bytes(seg[:80]).decode())
+    n_ints = 1 + has_ft.astype(int) + has_fn
+
+    ints = np.fromstring(bytes(seg).replace(b'f', b' ').replace(b'/', b' '), dtype=int, sep=' ')
+    if ints.size != (n_verts * n_ints).sum():
+        raise ValueError("Unidentified face format in %s" % bytes(seg[:80]).decode())
+
+    # Where each vertex's indices begin among all integers
+    n_ints_per_vert = np.repeat(n_ints, n_verts)
+    vert_starts = np.cumsum(n_ints_per_vert) - n_ints_per_vert
+    f = ints[vert_starts]
+    ft = ints[vert_starts[np.repeat(has_ft, n_verts)] + 1]
+    fn = ints[(vert_starts + n_ints_per_vert - 1)[np.repeat(has_fn, n_verts)]]
+    return f, ft, fn, n_verts, has_ft, has_fn
+
+
+def _indptr(counts):
+    # Where each face's indices begin, plus where the last one ends
+    return np.concatenate(([0], np.cumsum(counts)))
+
+
+def _to_csr(faces):
+    # Indices and index pointers of faces given as a list of lists or, if of the same size, an array
+    if faces is None:
+        return None, None
+    if isinstance(faces, np.ndarray):
+        return faces.astype(np.int32).ravel(), np.arange(0, faces.size + 1, max(faces.shape[1], 1))
+    counts = np.array([len(x) for x in faces], dtype=int)
+    indices = np.fromiter(chain.from_iterable(faces), dtype=np.int32, count=counts.sum())
+    return indices, _indptr(counts)
+
+
+def _csr_to_lists(indices, indptr):
+    # List of lists, with '[]' for faces of an empty range
+    if indices is None:
+        return None
+    counts = np.diff(indptr)
+    lists = [[] for _ in range(len(counts))]
+    # Faces with the same number of vertices in one go
+    for n in np.unique(counts).tolist():
+        if n == 0:
+            continue
+        which = np.flatnonzero(counts == n)
+        rows = indices[indptr[which, None] + np.arange(n)].tolist()
+        if len(which) == len(lists):
+            return rows
+        for i, row in zip(which.tolist(), rows):
+            lists[i] = row
+    return lists
+
+
+def _write_rows(fid, line_fmt, arr, chunk_size=100000):
+    # Formatting a chunk of rows at a time, instead of one row
+    for i in range(0, arr.shape[0], chunk_size):
+        rows = arr[i:i + chunk_size]
+        fid.write((line_fmt * rows.shape[0]) % tuple(rows.ravel().tolist()))
+
+
 class Mtl(object):
     def __init__(self, obj, Ns=96.078431, Ka=(1, 1, 1), Kd=(0.64, 0.64, 0.64),
                  Ks=(0.5, 0.5, 0.5), Ni=1, d=1, illum=2): # flake8: noqa